@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Measures encode time, decode time and size per frame of the tub image
+codecs, on 224x224x3 frames. \n
+Frames are synthetic unless --tub points to a tub, in which case its first
+images are used.
+
+Usage: python -m benchmarks.image_codec [--frames 200] [--tub ~/mycar/data]
+"""
+import argparse
+import time
+
+import numpy as np
+
+from components.image_codecs import available_image_codecs, \
+    create_image_codec, decode_image
+
+
+SETTINGS = [
+    {'codec': 'jpeg', 'quality': 75},
+    {'codec': 'jpeg', 'quality': 90},
+    {'codec': 'jpeg', 'quality': 90, 'subsampling': 0},
+    {'codec': 'png', 'compress_level': 1},
+    {'codec': 'png', 'compress_level': 6},
+    {'codec': 'npy'},
+    {'codec': 'cv2_jpeg', 'quality': 75},
+    {'codec': 'cv2_jpeg', 'quality': 90},
+]
+
+
+def synthetic_frames(count, height=224, width=224):
+    # Smooth gradients with some noise compress roughly like camera frames,
+    # pure noise would be the worst case for every codec.
+    random = np.random.default_rng(0)
+    rows = np.linspace(0, 255, height)[:, None, None]
+    columns = np.linspace(0, 255, width)[None, :, None]
+    frames = list()
+    for index in range(count):
+        base = (rows * 0.6 + columns * 0.4 + index) % 256
+        noise = random.normal(0, 8, size=(height, width, 3))
+        frames.append(np.clip(base + noise, 0, 255).astype(np.uint8))
+    return frames
+
+
+def tub_frames(path, count):
+    from components.tub_v2 import Tub
+    tub = Tub(path, read_only=True)
+    keys = [key for key, input_type in zip(tub.manifest.inputs,
+                                           tub.manifest.types)
+            if input_type == 'image_array']
+    frames = list()
+    for record in tub:
+        frames.append(tub.load_image(record[keys[0]]))
+        if len(frames) >= count:
+            break
+    tub.close()
+    return frames
+
+
+def describe(settings):
+    options = ', '.join(f'{key}={value}' for key, value in settings.items()
+                        if key != 'codec')
+    return f'{settings["codec"]}({options})'
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--frames', type=int, default=200)
+    parser.add_argument('--tub', help='read frames from this tub')
+    args = parser.parse_args()
+
+    frames = tub_frames(args.tub, args.frames) if args.tub \
+        else synthetic_frames(args.frames)
+    available = available_image_codecs()
+    print(f'{"codec":>38} {"encode ms":>10} {"decode ms":>10} '
+          f'{"bytes":>8}')
+    for settings in SETTINGS:
+        if settings['codec'] not in available:
+            print(f'{describe(settings):>38} {"not available":>10}')
+            continue
+        codec = create_image_codec(settings)
+        # Warm up, the first call loads the encoder
+        decode_image(codec.encode(frames[0]), codec.extension)
+        start = time.perf_counter()
+        encoded = [codec.encode(frame) for frame in frames]
+        encode = (time.perf_counter() - start) / len(frames) * 1000
+        start = time.perf_counter()
+        for contents in encoded:
+            decode_image(contents, codec.extension)
+        decode = (time.perf_counter() - start) / len(frames) * 1000
+        size = sum(len(contents) for contents in encoded) / len(encoded)
+        print(f'{describe(settings):>38} {encode:>10.3f} {decode:>10.3f} '
+              f'{size:>8.0f}')
+
+
+if __name__ == '__main__':
+    main()
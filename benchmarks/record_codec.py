@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Measures per-record encode and decode times of the catalog record codecs,
+for the records written by the drive loop. The json codec is the path used
+by earlier versions.
+
+Usage: python -m benchmarks.record_codec [--records 100000]
+"""
+import argparse
+import random
+import time
+
+from components.datastore_v2 import RECORD_CODECS, create_record_codec
+
+
+INPUTS = ['cam/image_array', 'user/angle', 'user/throttle', 'user/mode']
+TYPES = ['image_array', 'float', 'float', 'str']
+
+
+def make_records(count):
+    records = list()
+    for index in range(count):
+        records.append({
+            'cam/image_array': f'{index}_cam_image_array_.jpg',
+            'user/angle': random.uniform(-1, 1),
+            'user/throttle': random.uniform(0, 1),
+            'user/mode': 'user',
+            '_timestamp_ms': int(time.time() * 1000) + index * 50,
+            '_index': index,
+            '_session_id': '21-03-29_0',
+        })
+    return records
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--records', type=int, default=100000)
+    args = parser.parse_args()
+
+    records = make_records(args.records)
+    print(f'{"codec":>8} {"encode us":>10} {"decode us":>10} '
+          f'{"bytes":>7}')
+    for name in RECORD_CODECS:
+        codec = create_record_codec(name, INPUTS, TYPES)
+        start = time.perf_counter()
+        lines = [codec.encode(record) for record in records]
+        encode = (time.perf_counter() - start) / len(records) * 1e6
+        start = time.perf_counter()
+        decoded = [codec.decode(line) for line in lines]
+        decode = (time.perf_counter() - start) / len(records) * 1e6
+        assert decoded[-1] == records[-1]
+        size = sum(len(line) + 1 for line in lines) / len(lines)
+        print(f'{name:>8} {encode:>10.2f} {decode:>10.2f} {size:>7.1f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Measures how long it takes to open a catalog with Seekable, for catalogs
+from 1k to 1M lines. \n
+persisted: the line index is memory mapped from its .catalog_index file
+rebuild:   the line index is missing and rebuilt with the vectorized scan
+readline:  the previous rebuild, one readline() call per line
+
+Usage: python -m benchmarks.seekable_open [--sizes 1000 10000 ...]
+"""
+import argparse
+import json
+import os
+import tempfile
+import time
+
+from components.datastore_v2 import LineIndex, Seekable
+
+
+def write_catalog(path, lines):
+    record = {'cam/image_array': '0_cam_image_array_.jpg', 'user/angle': 0.0,
+              'user/throttle': 0.0, 'user/mode': 'user',
+              '_timestamp_ms': 0, '_session_id': '21-03-29_0'}
+    with open(path, 'w') as file:
+        for index in range(lines):
+            record['_index'] = index
+            file.write(json.dumps(record, sort_keys=True))
+            file.write('\n')
+
+
+def readline_rebuild(path):
+    total_length = 0
+    cumulative_lengths = list()
+    with open(path, 'r', newline='\n') as file:
+        contents = file.readline()
+        while len(contents) > 0:
+            total_length += len(contents)
+            cumulative_lengths.append(total_length)
+            contents = file.readline()
+    return cumulative_lengths
+
+
+def timed(function, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        function()
+        best = min(best, time.perf_counter() - start)
+    return best * 1000
+
+
+def open_seekable(path, index_path):
+    seekable = Seekable(path, read_only=True,
+                        line_index=LineIndex(index_path, read_only=True))
+    lines = seekable.lines()
+    seekable.close()
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"lines":>10} {"persisted ms":>14} {"rebuild ms":>12} '
+          f'{"readline ms":>13}')
+    with tempfile.TemporaryDirectory() as directory:
+        for size in args.sizes:
+            path = os.path.join(directory, f'catalog_{size}.catalog')
+            index_path = os.path.join(directory, f'catalog_{size}.index')
+            write_catalog(path, size)
+            # Build and persist the index once.
+            seekable = Seekable(path, line_index=LineIndex(index_path))
+            assert seekable.lines() == size
+            seekable.close()
+            missing_path = os.path.join(directory, 'missing.index')
+            persisted = timed(lambda: open_seekable(path, index_path),
+                              args.repeat)
+            rebuild = timed(lambda: open_seekable(path, missing_path),
+                            args.repeat)
+            readline = timed(lambda: readline_rebuild(path), args.repeat)
+            print(f'{size:>10} {persisted:>14.2f} {rebuild:>12.2f} '
+                  f'{readline:>13.2f}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""
+Measures the read throughput of TubDataset in frames per second, on a
+temporary tub of 224x224x3 jpeg frames.
+
+Usage: python -m benchmarks.tub_dataset [--records 2000] [--batch-size 64]
+"""
+import argparse
+import tempfile
+
+import numpy as np
+
+from components.tub_dataset import TubDataset
+from components.tub_v2 import Tub
+
+
+INPUTS = ['cam/image_array', 'user/angle', 'user/throttle']
+TYPES = ['image_array', 'float', 'float']
+
+
+def write_tub(path, records, image_storage):
+    random = np.random.default_rng(0)
+    frames = [random.integers(0, 255, size=(224, 224, 3), dtype=np.uint8)
+              for _ in range(16)]
+    tub = Tub(path, inputs=INPUTS, types=TYPES, image_storage=image_storage)
+    for index in range(records):
+        tub.write_record({'cam/image_array': frames[index % len(frames)],
+                          'user/angle': random.uniform(-1, 1),
+                          'user/throttle': random.uniform(0, 1)})
+    tub.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    args = parser.parse_args()
+
+    print(f'{"storage":>8} {"dtype":>8} {"frames/s":>10}')
+    for image_storage in ('files', 'blob'):
+        with tempfile.TemporaryDirectory() as directory:
+            write_tub(directory, args.records, image_storage)
+            tub = Tub(directory, read_only=True)
+            for dtype in (np.uint8, np.float32):
+                dataset = TubDataset(tub, batch_size=args.batch_size,
+                                     dtype=dtype, seed=0)
+                for _ in dataset:
+                    pass
+                print(f'{image_storage:>8} {np.dtype(dtype).name:>8} '
+                      f'{dataset.frames_per_second:>10.0f}')
+            tub.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Compares the throughput of TubDataset and TubLoader with 1 to --workers
+worker processes, in frames per second, on a temporary tub of 224x224x3
+jpeg frames.
+
+Usage: python -m benchmarks.tub_loader [--records 2000] [--workers 4]
+"""
+import argparse
+import tempfile
+
+from benchmarks.tub_dataset import write_tub
+from components.tub_dataset import TubDataset
+from components.tub_loader import TubLoader
+from components.tub_v2 import Tub
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--records', type=int, default=2000)
+    parser.add_argument('--batch-size', type=int, default=64)
+    parser.add_argument('--workers', type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        write_tub(directory, args.records, 'files')
+        tub = Tub(directory, read_only=True)
+        dataset = TubDataset(tub, batch_size=args.batch_size, seed=0)
+        for _ in dataset:
+            pass
+        print(f'{"loader":>12} {"frames/s":>10}')
+        print(f'{"dataset":>12} {dataset.frames_per_second:>10.0f}')
+        workers = 1
+        while workers <= args.workers:
+            with TubLoader(tub, batch_size=args.batch_size, seed=0,
+                           workers=workers) as loader:
+                # The first epoch includes the start of the workers.
+                for _ in loader:
+                    pass
+                loader.frames = 0
+                loader.seconds = 0.0
+                for _ in loader:
+                    pass
+                print(f'{f"{workers} workers":>12} '
+                      f'{loader.frames_per_second:>10.0f}')
+            workers *= 2
+        tub.close()
+
+
+if __name__ == '__main__':
+    main()
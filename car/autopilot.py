@@ -3,6 +3,7 @@
 from components.actuator import PCA9685, PWMSteering, PWMThrottle
 from components.camera import CSICamera
 from components.joystick import PS4JoystickController
+from components.datastore_v2 import DurabilityPolicy
 from components.tub_v2 import TubWriter
 from components.web import WebFpv
 import getpass
@@ -142,7 +143,19 @@ def drive(tub_path=None, model_path=None, model_type=None):
 
         tub_path += '{}/'.format(num)
 
-    tub_writer = TubWriter(base_path=tub_path, inputs=inputs, types=types)
+    # Commit records to disk once per second instead of on every record,
+    # which keeps the file system syscalls out of the drive loop.
+    TUB_DURABILITY = DurabilityPolicy(mode='interval', interval_ms=1000)
+    # Encode camera images on background threads, dropping the oldest queued
+    # record when the encoders fall behind instead of stalling the loop.
+    TUB_IMAGE_WORKERS = 2
+    TUB_IMAGE_QUEUE_SIZE = 20
+    TUB_IMAGE_POLICY = 'drop_oldest'
+    tub_writer = TubWriter(base_path=tub_path, inputs=inputs, types=types,
+                           durability=TUB_DURABILITY,
+                           image_workers=TUB_IMAGE_WORKERS,
+                           image_queue_size=TUB_IMAGE_QUEUE_SIZE,
+                           image_policy=TUB_IMAGE_POLICY)
     car.add(tub_writer,
             inputs=inputs,
             outputs=["tub/num_records"],
@@ -165,12 +165,23 @@ def load_pil_image(filename, cfg):
         return None
 
 
-def load_image(filename, cfg):
+def load_image(filename, cfg, cache=None):
     """
     :param string filename:     path to image file
     :param cfg:                 donkey config
+    :param cache:               optional components.image_cache.ImageCache,
+                                the returned array is then read only
     :return np.ndarray:         numpy uint8 image array
     """
+    if cache is not None:
+        key = (None, filename, (cfg.IMAGE_W, cfg.IMAGE_H), cfg.IMAGE_DEPTH)
+        img_arr = cache.get(key)
+        if img_arr is None:
+            img_arr = load_image(filename, cfg)
+            if img_arr is not None:
+                cache.put(key, img_arr)
+        return img_arr
+
     img = load_pil_image(filename, cfg)
 
     if not img:
@@ -209,16 +220,17 @@ def make_dir(path):
 
 def zip_dir(dir_path, zip_path):
     """
-    Create and save a zipfile of a one level directory
+    Create and save a zipfile of a directory and its sub directories.
+    Tubs are better shipped incrementally with components.tub_sync.
     """
-    file_paths = glob.glob(dir_path + "/*") #create path to search for files.
-
-    zf = zipfile.ZipFile(zip_path, 'w')
-    dir_name = os.path.basename(dir_path)
-    for p in file_paths:
-        file_name = os.path.basename(p)
-        zf.write(p, arcname=os.path.join(dir_name, file_name))
-    zf.close()
+    dir_name = os.path.basename(os.path.normpath(dir_path))
+    with zipfile.ZipFile(zip_path, 'w') as zf:
+        for root, _, file_names in os.walk(dir_path):
+            for file_name in sorted(file_names):
+                p = os.path.join(root, file_name)
+                arcname = os.path.join(dir_name, os.path.relpath(p, dir_path))
+                # Files are streamed into the archive a block at a time
+                zf.write(p, arcname=arcname)
     return zip_path
 
 
@@ -251,6 +263,16 @@ def linear_bin(a, N=15, offset=1, R=2.0):
     return arr
 
 
+def linear_bin_index(a, N=15, offset=1, R=2.0):
+    '''
+    vectorized linear_bin, returns the index of the hot bin
+    of every value of the array a
+    '''
+    a = np.asarray(a, dtype=np.float64) + offset
+    b = np.round(a / (R / (N - offset)))
+    return np.clip(b, 0, N - 1).astype(np.int64)
+
+
 def linear_unbin(arr, N=15, offset=-1, R=2.0):
     '''
     preform inverse linear_bin, taking
@@ -440,15 +462,15 @@ def train_test_split(data_list: List[Any],
     target_train_size = int(len(data_list) * (1. - test_size))
 
     if shuffle:
-        train_data = []
-        i_sample = 0
-        while i_sample < target_train_size and len(data_list) > 1:
-            i_choice = random.randint(0, len(data_list) - 1)
-            train_data.append(data_list.pop(i_choice))
-            i_sample += 1
-
+        # Draw the training positions at once, popping random elements is
+        # quadratic. At least one element is left for validation.
+        target_train_size = min(target_train_size, max(len(data_list) - 1, 0))
+        chosen = random.sample(range(len(data_list)), target_train_size)
+        train_data = [data_list[i] for i in chosen]
+        chosen = set(chosen)
         # remainder of the original list is the validation set
-        val_data = data_list
+        val_data = [item for i, item in enumerate(data_list)
+                    if i not in chosen]
 
     else:
         train_data = data_list[:target_train_size]
@@ -0,0 +1,100 @@
+import numpy as np
+
+
+class BatchAugmentation(object):
+    """
+    Augments whole (B, H, W, C) batches of images with numpy, drawing the
+    parameters of every sample from a seeded generator. \n
+    - flip: probability of a horizontal flip, which negates angle_key
+    - brightness: largest offset, as a fraction of the pixel range
+    - contrast: largest change of contrast around the image mean, 0.2
+      scales it by 0.8 to 1.2
+    - crop: largest shift in pixels of a random crop, the image is moved by
+      up to crop pixels in both directions and its edges are repeated
+    - shadow: probability of darkening the image on one side of a random
+      line from the top to the bottom edge \n
+    Batches are uint8 in [0, 255] or float in [0, 1] and are augmented in
+    place, labels are the dict of (B,) arrays of the batch readers. Pass an
+    instance as the augmentation of TubDataset, TubLoader or
+    TubCache.batches().
+    """
+
+    def __init__(self, flip=0.5, brightness=0.2, contrast=0.2, crop=0,
+                 shadow=0.0, angle_key='user/angle', seed=None):
+        self.flip = flip
+        self.brightness = brightness
+        self.contrast = contrast
+        self.crop = crop
+        self.shadow = shadow
+        self.angle_key = angle_key
+        self.random = np.random.default_rng(seed)
+        # float32 buffer for the color changes, reused between batches
+        self.work = None
+
+    def __call__(self, images, labels):
+        if self.flip > 0:
+            self._flip(images, labels)
+        if self.crop > 0:
+            self._crop(images)
+        if self.brightness > 0 or self.contrast > 0 or self.shadow > 0:
+            self._color(images)
+        return images, labels
+
+    def _flip(self, images, labels):
+        flipped = np.flatnonzero(self.random.random(len(images)) < self.flip)
+        if len(flipped) == 0:
+            return
+        images[flipped] = images[flipped, :, ::-1]
+        angles = labels.get(self.angle_key)
+        if angles is not None:
+            angles[flipped] = -angles[flipped]
+
+    def _crop(self, images):
+        count, height, width = images.shape[:3]
+        shifts = self.random.integers(-self.crop, self.crop + 1,
+                                      size=(2, count))
+        rows = np.clip(np.arange(height) + shifts[0][:, None], 0, height - 1)
+        columns = np.clip(np.arange(width) + shifts[1][:, None], 0,
+                          width - 1)
+        images[...] = images[np.arange(count)[:, None, None],
+                             rows[:, :, None], columns[:, None, :]]
+
+    def _color(self, images):
+        count, height, width = images.shape[:3]
+        top = 255.0 if images.dtype == np.uint8 else 1.0
+        if self.work is None or self.work.shape != images.shape:
+            self.work = np.empty(images.shape, dtype=np.float32)
+        work = self.work
+        np.copyto(work, images, casting='unsafe')
+        if self.contrast > 0:
+            factors = self.random.uniform(1 - self.contrast, 1 + self.contrast,
+                                          size=count).astype(np.float32)
+            means = work.mean(axis=(1, 2, 3))
+            work -= means[:, None, None, None]
+            work *= factors[:, None, None, None]
+            work += means[:, None, None, None]
+        if self.brightness > 0:
+            offsets = self.random.uniform(-self.brightness, self.brightness,
+                                          size=count).astype(np.float32)
+            work += (offsets * top)[:, None, None, None]
+        if self.shadow > 0:
+            work *= self._shadow_factors(count, height, width)[..., None]
+        np.clip(work, 0, top, out=work)
+        if images.dtype == np.uint8:
+            np.rint(work, out=work)
+        np.copyto(images, work, casting='unsafe')
+
+    def _shadow_factors(self, count, height, width):
+        """ (B, H, W) factors, below 1 on the shadowed side of the line. """
+        shadowed = self.random.random(count) < self.shadow
+        darkness = np.where(shadowed,
+                            self.random.uniform(0.5, 0.9, size=count), 1.0)
+        top_x, bottom_x = self.random.uniform(0, width, size=(2, count))
+        rows = np.arange(height) / max(height - 1, 1)
+        # Column of the line on every row, (B, H)
+        line = top_x[:, None] + (bottom_x - top_x)[:, None] * rows
+        left = np.arange(width) < line[:, :, None]
+        side = self.random.random(count) < 0.5
+        in_shadow = left == side[:, None, None]
+        return np.where(in_shadow, darkness[:, None, None],
+                        1.0).astype(np.float32)
@@ -1,52 +1,475 @@
+import base64
 import json
+import math
 import mmap
 import os
+import struct
+import sys
+import threading
 import time
+from array import array
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict, deque
 from pathlib import Path
 
+import numpy as np
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 NEWLINE = '\n'
 NEWLINE_STRIP = '\r\n'
+# Bytes scanned per step when looking for newlines, bounds the temporary
+# memory used to rebuild an index.
+SCAN_CHUNK_SIZE = 16 * 1024 * 1024
+
+
+def line_end_offsets(buffer, size):
+    """
+    Finds the end offset of every line in the first size bytes of a buffer,
+    using a vectorized scan for newlines. A trailing line without a newline
+    is included. \n
+    Returns a compact array('Q') of cumulative line lengths.
+    """
+    newline = ord(NEWLINE)
+    chunks = list()
+    for start in range(0, size, SCAN_CHUNK_SIZE):
+        count = min(SCAN_CHUNK_SIZE, size - start)
+        data = np.frombuffer(buffer, dtype=np.uint8, count=count,
+                             offset=start)
+        chunks.append(np.flatnonzero(data == newline) + (start + 1))
+        # Release the export of the buffer, so it can be closed later on.
+        del data
+    offsets = np.concatenate(chunks).astype(np.uint64) if chunks \
+        else np.empty(0, dtype=np.uint64)
+    if size > 0 and (len(offsets) == 0 or offsets[-1] != size):
+        offsets = np.append(offsets, np.uint64(size))
+    return array(LineIndex.TYPE_CODE, offsets.tobytes())
+
+
+class LineIndex(object):
+    """
+    An append-only index of line end offsets for a newline delimited file. \n
+    Offsets are stored as fixed-width little endian unsigned 64 bit integers,
+    so indexing a new line costs a single 8 byte append. The persisted part
+    of the index is memory mapped, which makes opening an index a O(1)
+    operation. Without a path the index is only kept in memory.
+    """
+
+    TYPE_CODE = 'Q'
+    ITEM_SIZE = 8
+    ENTRY = struct.Struct('<Q')
+
+    def __init__(self, path=None, read_only=False, auto_flush=True):
+        self.path = path
+        self.read_only = read_only
+        self.auto_flush = auto_flush
+        self.file = None
+        self.mapped_file = None
+        self.mapped = memoryview(b'').cast(LineIndex.TYPE_CODE)
+        self.appended = array(LineIndex.TYPE_CODE)
+        if self.path is not None:
+            if not self.read_only:
+                self.file = open(self.path, 'ab')
+            self._map()
+
+    def _map(self):
+        self._unmap()
+        if not os.path.exists(self.path):
+            return
+        size = os.path.getsize(self.path)
+        # Ignore a partially written trailing entry.
+        size -= size % LineIndex.ITEM_SIZE
+        if size <= 0:
+            return
+        with open(self.path, 'rb') as file:
+            if sys.byteorder == 'little':
+                self.mapped_file = mmap.mmap(file.fileno(), length=size,
+                                             access=mmap.ACCESS_READ)
+                self.mapped = memoryview(self.mapped_file)\
+                    .cast(LineIndex.TYPE_CODE)
+            else:
+                # The on-disk format is little endian, so big endian hosts
+                # need to swap bytes and can not use the mapped buffer.
+                entries = array(LineIndex.TYPE_CODE)
+                entries.frombytes(file.read(size))
+                entries.byteswap()
+                self.mapped = memoryview(entries)
+
+    def _unmap(self):
+        self.mapped.release()
+        self.mapped = memoryview(b'').cast(LineIndex.TYPE_CODE)
+        if self.mapped_file is not None:
+            self.mapped_file.close()
+            self.mapped_file = None
+
+    def _write(self, entries):
+        if self.file is None:
+            return
+        if sys.byteorder != 'little':
+            entries = array(LineIndex.TYPE_CODE, entries)
+            entries.byteswap()
+        self.file.write(entries.tobytes())
+        if self.auto_flush:
+            self.file.flush()
+
+    def flush(self, fsync=False):
+        if self.file is None:
+            return
+        self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+
+    def append(self, offset):
+        self.appended.append(offset)
+        if self.file is not None:
+            self.file.write(LineIndex.ENTRY.pack(offset))
+            if self.auto_flush:
+                self.file.flush()
+
+    def extend(self, offsets):
+        entries = array(LineIndex.TYPE_CODE, offsets)
+        self.appended.extend(entries)
+        self._write(entries)
+
+    def truncate(self, length):
+        mapped_length = len(self.mapped)
+        if length >= mapped_length:
+            del self.appended[length - mapped_length:]
+            if self.file is not None:
+                self.file.truncate(len(self) * LineIndex.ITEM_SIZE)
+        elif self.file is not None:
+            self._unmap()
+            self.appended = array(LineIndex.TYPE_CODE)
+            self.file.truncate(length * LineIndex.ITEM_SIZE)
+            self._map()
+        else:
+            # Read only, keep the remaining entries in memory.
+            self.appended = array(LineIndex.TYPE_CODE, self.mapped[:length])
+            self._unmap()
+
+    def __len__(self):
+        return len(self.mapped) + len(self.appended)
+
+    def __getitem__(self, index):
+        length = len(self)
+        if index < 0:
+            index += length
+        if not 0 <= index < length:
+            raise IndexError(f'LineIndex index {index} out of range')
+        mapped_length = len(self.mapped)
+        if index < mapped_length:
+            return self.mapped[index]
+        return self.appended[index - mapped_length]
+
+    def __iter__(self):
+        yield from self.mapped
+        yield from self.appended
+
+    def to_array(self):
+        """ Returns a copy of the index as a numpy uint64 array. """
+        return np.concatenate([
+            np.array(self.mapped, dtype=np.uint64),
+            np.frombuffer(self.appended, dtype=np.uint64)])
+
+    def close(self):
+        self._unmap()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class JsonRecordCodec(object):
+    """
+    Encodes records as json objects, one per catalog line. This is the
+    default codec, and the one used by tubs which do not name a codec.
+    """
+
+    name = 'json'
+
+    def encode(self, record):
+        return json.dumps(record, allow_nan=False, sort_keys=True)
+
+    def decode(self, contents):
+        return json.loads(contents)
+
+    def decode_lines(self, lines):
+        """ Decodes a list of catalog lines, as bytes, as one json array. """
+        return json.loads(b'[' + b','.join(lines) + b']')
+
+    def describe(self):
+        return {'name': self.name}
+
+
+class OrjsonRecordCodec(JsonRecordCodec):
+    """
+    Same json catalog lines, encoded and decoded with orjson when it is
+    installed. Catalogs stay readable by the json codec. \n
+    orjson writes NaN and infinities as null, records holding them raise a
+    ValueError instead, like they do with the json codec.
+    """
+
+    name = 'orjson'
+
+    def __init__(self):
+        if orjson is None:
+            print('orjson is not installed, using json to encode records.')
+
+    def encode(self, record):
+        if orjson is None:
+            return super().encode(record)
+        OrjsonRecordCodec._check_finite(record)
+        return orjson.dumps(record, option=orjson.OPT_SORT_KEYS)\
+            .decode('utf-8')
+
+    def decode(self, contents):
+        if orjson is None:
+            return super().decode(contents)
+        return orjson.loads(contents)
+
+    @classmethod
+    def _check_finite(cls, value):
+        if isinstance(value, float):
+            if not math.isfinite(value):
+                raise ValueError(f'Out of range float values are not JSON '
+                                 f'compliant: {value}')
+        elif isinstance(value, dict):
+            for item in value.values():
+                cls._check_finite(item)
+        elif isinstance(value, (list, tuple)):
+            for item in value:
+                cls._check_finite(item)
+
+    def decode_lines(self, lines):
+        if orjson is None:
+            return super().decode_lines(lines)
+        return orjson.loads(b'[' + b','.join(lines) + b']')
+
+
+class BinaryRecordCodec(object):
+    """
+    A fixed schema binary codec, built from the inputs and types of a tub. \n
+    Each record is a single struct with a presence bitmask, the numeric
+    fields and the byte lengths of the string fields, followed by the utf-8
+    strings. The bytes are base64 encoded, so catalogs stay newline
+    delimited. Keys which are not part of the schema are kept in a trailing
+    json string.
+    """
+
+    name = 'binary'
+    # Tub types and how the codec stores them
+    KINDS = {
+        'float': 'float',
+        'int': 'int',
+        'boolean': 'boolean',
+        'str': 'str',
+        'image_array': 'str',
+    }
+    FORMATS = {'float': 'd', 'int': 'q', 'boolean': '?'}
+    PRIVATE_FIELDS = [['_index', 'int'], ['_timestamp_ms', 'int'],
+                      ['_session_id', 'str']]
+
+    def __init__(self, fields):
+        self.fields = [list(field) for field in fields]
+        self.fixed_fields = [(1 << position, name)
+                             for position, (name, kind) in enumerate(fields)
+                             if kind in BinaryRecordCodec.FORMATS]
+        self.variable_fields = [(1 << position, name, kind == 'json')
+                                for position, (name, kind) in enumerate(fields)
+                                if kind not in BinaryRecordCodec.FORMATS]
+        self.names = set(name for name, _ in fields)
+        self.extras_bit = 1 << len(fields)
+        self.mask_size = (len(fields) + 1 + 7) // 8
+        fixed_format = ''.join(BinaryRecordCodec.FORMATS[kind]
+                               for name, kind in fields
+                               if kind in BinaryRecordCodec.FORMATS)
+        # The extra string holds keys which are not part of the schema.
+        lengths_format = 'I' * (len(self.variable_fields) + 1)
+        self.header = struct.Struct(
+            f'<{self.mask_size}s{fixed_format}{lengths_format}')
+
+    @classmethod
+    def from_schema(cls, inputs, types):
+        fields = list()
+        for name, input_type in zip(inputs, types):
+            # Lists, vectors and unknown types are stored as json strings.
+            kind = BinaryRecordCodec.KINDS.get(input_type, 'json')
+            fields.append([name, kind])
+        fields.extend(BinaryRecordCodec.PRIVATE_FIELDS)
+        return cls(fields)
+
+    def encode(self, record):
+        mask = 0
+        values = list()
+        for bit, name in self.fixed_fields:
+            value = record.get(name)
+            if value is None:
+                values.append(0)
+            else:
+                mask |= bit
+                values.append(value)
+        strings = list()
+        for bit, name, is_json in self.variable_fields:
+            value = record.get(name)
+            if value is None:
+                encoded = b''
+            else:
+                mask |= bit
+                if is_json:
+                    value = json.dumps(value, allow_nan=False)
+                encoded = value.encode('utf-8')
+            strings.append(encoded)
+            values.append(len(encoded))
+        extras = {key: value for key, value in record.items()
+                  if key not in self.names}
+        encoded = b''
+        if extras:
+            mask |= self.extras_bit
+            encoded = json.dumps(extras, allow_nan=False).encode('utf-8')
+        strings.append(encoded)
+        values.append(len(encoded))
+        header = self.header.pack(mask.to_bytes(self.mask_size, 'little'),
+                                  *values)
+        return base64.b64encode(header + b''.join(strings)).decode('ascii')
+
+    def decode(self, contents):
+        data = base64.b64decode(contents)
+        values = self.header.unpack_from(data)
+        mask = int.from_bytes(values[0], 'little')
+        record = dict()
+        position = 1
+        for bit, name in self.fixed_fields:
+            if mask & bit:
+                record[name] = values[position]
+            position += 1
+        offset = self.header.size
+        for bit, name, is_json in self.variable_fields:
+            end = offset + values[position]
+            position += 1
+            if mask & bit:
+                value = data[offset:end].decode('utf-8')
+                record[name] = json.loads(value) if is_json else value
+            offset = end
+        if mask & self.extras_bit:
+            record.update(json.loads(data[offset:].decode('utf-8')))
+        return record
+
+    def decode_lines(self, lines):
+        return [self.decode(line) for line in lines]
+
+    def describe(self):
+        return {'name': self.name, 'fields': self.fields}
+
+
+RECORD_CODECS = ('json', 'orjson', 'binary')
+
+
+def create_record_codec(name='json', inputs=[], types=[]):
+    """ Creates a record codec for a new tub. """
+    if name == JsonRecordCodec.name:
+        return JsonRecordCodec()
+    elif name == OrjsonRecordCodec.name:
+        return OrjsonRecordCodec()
+    elif name == BinaryRecordCodec.name:
+        return BinaryRecordCodec.from_schema(inputs, types)
+    raise ValueError(f'Unknown record codec {name}, expected one of '
+                     f'{RECORD_CODECS}')
+
+
+def record_codec_from_description(description):
+    """ Creates the record codec described in a tub manifest. """
+    if description is None:
+        # Tubs written before record codecs existed
+        return JsonRecordCodec()
+    name = description['name']
+    if name == BinaryRecordCodec.name:
+        return BinaryRecordCodec(description['fields'])
+    return create_record_codec(name)
+
+
+def read_manifest_file(path):
+    """
+    Reads a manifest.json without opening the tub. Returns its contents, as
+    bytes, and its five lines: inputs, types, user metadata, manifest
+    metadata and catalog metadata. Raises a ValueError when the file is
+    incomplete, like while the writer rewrites its last line.
+    """
+    with open(path, 'rb') as file:
+        contents = file.read()
+    lines = contents.split(NEWLINE.encode())
+    if len(lines) < 5:
+        raise ValueError(f'{path} has {len(lines)} of 5 lines')
+    return contents, [json.loads(line) for line in lines[:5]]
 
 
 class Seekable(object):
     """
     A seekable file reader, writer which deals with newline delimited
     records. \n
-    This reader maintains an index of line lengths, so seeking a line is a
-    O(1) operation.
+    This reader maintains an index of line end offsets, so seeking a line is
+    a O(1) operation. The index can be persisted by passing a file backed
+    LineIndex, in which case it is only rebuilt when it is out of sync with
+    the file. \n
+    read_line() and read_lines() read lines at their offsets with os.pread
+    or memory map slices, without the shared file position, so threads can
+    read through the same Seekable.
     """
 
-    def __init__(self, file, read_only=False, line_lengths=list()):
-        self.line_lengths = list()
-        self.cumulative_lengths = list()
+    def __init__(self, file, read_only=False, line_lengths=list(),
+                 line_index=None, auto_flush=True):
+        self.cumulative_lengths = line_index if line_index is not None \
+            else LineIndex()
+        # When disabled, callers are responsible for calling flush().
+        self.auto_flush = auto_flush
+        # Guards the write buffer, which readers flush from other threads
+        self.write_lock = threading.Lock()
         self.method = 'r' if read_only else 'a+'
-        self.file = open(file, self.method, newline=NEWLINE)
+        self.file = open(file, self.method, newline=NEWLINE,
+                         encoding='utf-8')
         # If file is read only improve performance by memory mapping the file.
-        if self.method == 'r':
+        # Empty files can not be memory mapped.
+        if self.method == 'r' and os.fstat(self.file.fileno()).st_size > 0:
             self.file = mmap.mmap(self.file.fileno(), length=0,
                                   access=mmap.ACCESS_READ)
         self.total_length = 0
-        if len(line_lengths) <= 0:
-            self._read_contents()
-        else:
-            self.line_lengths.extend(line_lengths)
-            for line_length in self.line_lengths:
+        if len(line_lengths) > 0 and len(self.cumulative_lengths) <= 0:
+            for line_length in line_lengths:
                 self.total_length += line_length
                 self.cumulative_lengths.append(self.total_length)
+        if len(self.cumulative_lengths) > 0:
+            self.total_length = self.cumulative_lengths[-1]
+        if self.total_length <= 0 or self.total_length != self._file_size():
+            self._read_contents()
+        else:
+            self.seek_end_of_file()
+
+    @property
+    def line_lengths(self):
+        return np.diff(self.cumulative_lengths.to_array(),
+                       prepend=np.uint64(0))
+
+    def _file_size(self):
+        if isinstance(self.file, mmap.mmap):
+            return self.file.size()
+        return os.fstat(self.file.fileno()).st_size
 
     def _read_contents(self):
-        self.line_lengths.clear()
-        self.cumulative_lengths.clear()
-        self.total_length = 0
-        self.file.seek(0)
-        contents = self.file.readline()
-        while len(contents) > 0:
-            line_length = len(contents)
-            self.line_lengths.append(line_length)
-            self.total_length += line_length
-            self.cumulative_lengths.append(self.total_length)
-            contents = self.file.readline()
+        self.cumulative_lengths.truncate(0)
+        size = self._file_size()
+        if isinstance(self.file, mmap.mmap):
+            offsets = line_end_offsets(self.file, size)
+        elif size > 0:
+            self.file.flush()
+            with mmap.mmap(self.file.fileno(), length=size,
+                           access=mmap.ACCESS_READ) as buffer:
+                offsets = line_end_offsets(buffer, size)
+        else:
+            offsets = array(LineIndex.TYPE_CODE)
+        self.cumulative_lengths.extend(offsets)
+        self.total_length = offsets[-1] if len(offsets) > 0 else 0
         self.seek_end_of_file()
 
     def __enter__(self):
@@ -62,12 +485,15 @@ class Seekable(object):
         else:
             line = f'{contents}{NEWLINE}'
 
-        offset = len(line)
-        self.total_length += offset
-        self.line_lengths.append(offset)
+        with self.write_lock:
+            self.file.write(line)
+            if self.auto_flush:
+                self.file.flush()
+        # Index the line only after it was written, so a crash in between
+        # leaves a short index which is rebuilt on the next open.
+        # Offsets are in bytes, records encoded by orjson are raw UTF-8.
+        self.total_length += len(line.encode('utf-8'))
         self.cumulative_lengths.append(self.total_length)
-        self.file.write(line)
-        self.file.flush()
 
     def _line_start_offset(self, line_number):
         return self._offset_until(line_number - 1)
@@ -87,6 +513,40 @@ class Seekable(object):
             contents = contents.decode(encoding='utf-8')
         return contents.rstrip(NEWLINE_STRIP)
 
+    def read_line(self, line_number):
+        """ Reads a line, numbered from 1, without moving the file
+            position. """
+        if not 0 < line_number <= self.lines():
+            raise IndexError(f'Line {line_number} out of range')
+        contents = self._read_bytes(self._line_start_offset(line_number),
+                                    self._line_end_offset(line_number))
+        return contents.decode(encoding='utf-8').rstrip(NEWLINE_STRIP)
+
+    def read_lines(self, line_numbers):
+        """ Reads lines, numbered from 1, without moving the file position.
+            A range of lines is a single read. """
+        if isinstance(line_numbers, range) and line_numbers.step == 1:
+            if len(line_numbers) == 0:
+                return list()
+            first, last = line_numbers[0], line_numbers[-1]
+            if first < 1 or last > self.lines():
+                raise IndexError(f'Lines {first} to {last} out of range')
+            contents = self._read_bytes(self._line_start_offset(first),
+                                        self._line_end_offset(last))
+            lines = contents.decode(encoding='utf-8').split(NEWLINE)
+            # The last line ends with a newline
+            return [line.rstrip(NEWLINE_STRIP) for line in lines[:-1]]
+        return [self.read_line(line_number) for line_number in line_numbers]
+
+    def _read_bytes(self, start, end):
+        if isinstance(self.file, mmap.mmap):
+            return self.file[start:end]
+        if self.method != 'r' and not self.auto_flush:
+            # Lines still buffered by the writer, flushed between its writes
+            with self.write_lock:
+                self.file.flush()
+        return os.pread(self.file.fileno(), end - start, start)
+
     def seek_line_start(self, line_number):
         self.file.seek(self._line_start_offset(line_number))
 
@@ -94,24 +554,26 @@ class Seekable(object):
         self.file.seek(self.total_length)
 
     def truncate_until_end(self, line_number):
-        self.line_lengths = self.line_lengths[:line_number]
-        self.cumulative_lengths = self.cumulative_lengths[:line_number]
+        self.cumulative_lengths.truncate(line_number)
         self.total_length = self.cumulative_lengths[-1] \
             if len(self.cumulative_lengths) > 0 else 0
         self.seek_end_of_file()
         self.file.truncate()
     
+    def truncate_unterminated_line(self):
+        """ Removes a last line without a newline, left by a write which
+            was cut short, so the next line does not land on it. Returns
+            True when a line was removed. """
+        if self.total_length <= 0:
+            return False
+        last = self._read_bytes(self.total_length - 1, self.total_length)
+        if last == NEWLINE.encode():
+            return False
+        self.truncate_until_end(self.lines() - 1)
+        return True
+
     def read_from(self, line_number):
-        current_offset = self.file.tell()
-        self.seek_line_start(line_number)
-        lines = list()
-        contents = self.readline()
-        while len(contents) > 0:
-            lines.append(contents)
-            contents = self.readline()
-        
-        self.file.seek(current_offset)
-        return lines
+        return self.read_lines(range(max(line_number, 1), self.lines() + 1))
     
     def update_line(self, line_number, contents):
         lines = self.read_from(line_number)
@@ -122,14 +584,25 @@ class Seekable(object):
             for line in lines[1:]:
                 self.writeline(line)
 
+    def flush(self, fsync=False):
+        if self.method == 'r':
+            return
+        with self.write_lock:
+            self.file.flush()
+        if fsync:
+            os.fsync(self.file.fileno())
+        # The index is flushed last, a longer index than file gets rebuilt.
+        self.cumulative_lengths.flush(fsync=fsync)
+
     def lines(self):
-        return len(self.line_lengths)
+        return len(self.cumulative_lengths)
 
     def has_content(self):
         return self.lines() > 0
 
     def close(self):
         self.file.close()
+        self.cumulative_lengths.close()
 
     def __exit__(self, type, value, traceback):
         self.close()
@@ -143,24 +616,38 @@ class Catalog(object):
     [ json object record ] \n
     ...
     '''
-    def __init__(self, path, read_only=False, start_index=0):
+    def __init__(self, path, read_only=False, start_index=0,
+                 auto_flush=True, record_codec=None):
         self.path = Path(os.path.expanduser(path))
+        self.record_codec = record_codec if record_codec is not None \
+            else JsonRecordCodec()
         self.manifest = CatalogMetadata(self.path,
                                         read_only=read_only,
-                                        start_index=start_index)
+                                        start_index=start_index,
+                                        auto_flush=auto_flush)
         self.seekable = Seekable(self.path.as_posix(),
                                  line_lengths=self.manifest.line_lengths(),
-                                 read_only=read_only)
+                                 line_index=self.manifest.line_index,
+                                 read_only=read_only,
+                                 auto_flush=auto_flush)
 
     def _exit_handler(self):
         self.close()
 
     def write_record(self, record):
-        # Add record and update manifest
-        contents = json.dumps(record, allow_nan=False, sort_keys=True)
+        # Add record, the seekable appends its offset to the line index
+        contents = self.record_codec.encode(record)
         self.seekable.writeline(contents)
-        line_lengths = self.seekable.line_lengths
-        self.manifest.update_line_lengths(line_lengths)
+
+    def read_line(self, line_number):
+        """ Reads the line of a record, numbered from 1, see Seekable. """
+        return self.seekable.read_line(line_number)
+
+    def read_lines(self, line_numbers):
+        return self.seekable.read_lines(line_numbers)
+
+    def flush(self, fsync=False):
+        self.seekable.flush(fsync=fsync)
 
     def close(self):
         self.manifest.close()
@@ -169,14 +656,27 @@ class Catalog(object):
 
 class CatalogMetadata(object):
     '''
-    Manifest for a Catalog
+    Manifest for a Catalog. \n
+    The metadata lives in a small json file which is written once, the line
+    offsets of the catalog are kept in an append-only binary LineIndex.
+    Catalog manifests written by older versions, which store the line
+    lengths as a json list, are migrated when opened for writing, which
+    Manifest does for every catalog of a tub opened for writing.
     '''
-    def __init__(self, catalog_path, read_only=False, start_index=0):
+    def __init__(self, catalog_path, read_only=False, start_index=0,
+                 auto_flush=True):
         path = Path(catalog_path)
         manifest_name = f'{path.stem}.catalog_manifest'
         self.manifest_path = Path(os.path.join(path.parent.as_posix(),
                                                manifest_name))
+        index_name = f'{path.stem}.catalog_index'
+        self.index_path = Path(os.path.join(path.parent.as_posix(),
+                                            index_name))
+        self.read_only = read_only
         self.seekeable = Seekable(self.manifest_path, read_only=read_only)
+        self.line_index = LineIndex(self.index_path, read_only=read_only,
+                                    auto_flush=auto_flush)
+        self.legacy_line_lengths = list()
         has_contents = False
         if os.path.exists(self.manifest_path) and self.seekeable.has_content():
             self.seekeable.seek_line_start(1)
@@ -192,15 +692,20 @@ class CatalogMetadata(object):
             created_at = time.time()
             self.contents['created_at'] = created_at
             self.contents['start_index'] = start_index
-            self.contents['line_lengths'] = list()
             self._update()
-
-    def update_line_lengths(self, new_lengths):
-        self.contents['line_lengths'] = new_lengths
-        self._update()
+        elif 'line_lengths' in self.contents:
+            self._migrate_line_lengths()
+
+    def _migrate_line_lengths(self):
+        line_lengths = self.contents.pop('line_lengths')
+        if len(self.line_index) <= 0:
+            # The Seekable builds the index from these lengths.
+            self.legacy_line_lengths = line_lengths
+        if not self.read_only:
+            self._update()
 
     def line_lengths(self):
-        return self.contents['line_lengths']
+        return self.legacy_line_lengths
 
     def start_index(self):
         return self.contents['start_index']
@@ -212,6 +717,174 @@ class CatalogMetadata(object):
 
     def close(self):
         self.seekeable.close()
+        self.line_index.close()
+
+
+class IndexRanges(object):
+    """
+    A set of record indexes, stored as sorted and non overlapping half open
+    [start, end) ranges. \n
+    Runs of consecutive indexes, like erasing the last 100 records, take a
+    single range to store and serialize. Membership tests are a binary
+    search.
+    """
+
+    def __init__(self, ranges=()):
+        self.starts = list()
+        self.ends = list()
+        self.length = 0
+        for start, end in ranges:
+            self.add_range(start, end)
+
+    @classmethod
+    def from_catalog_metadata(cls, catalog_metadata):
+        """ The deleted records of a manifest's catalog metadata. """
+        if 'deleted_ranges' in catalog_metadata:
+            return cls(catalog_metadata['deleted_ranges'])
+        # Written by older versions, a flat list of indexes
+        return cls.from_indexes(catalog_metadata.get('deleted_indexes', []))
+
+    @classmethod
+    def from_indexes(cls, indexes):
+        ranges = IndexRanges()
+        for index in sorted(indexes):
+            ranges.add(index)
+        return ranges
+
+    def add(self, index):
+        self.add_range(index, index + 1)
+
+    def discard(self, index):
+        self.discard_range(index, index + 1)
+
+    def add_range(self, start, end):
+        if start >= end:
+            return
+        if self.ends and self.starts[-1] <= start <= self.ends[-1]:
+            # Extends the last range, the usual case when appending.
+            if end > self.ends[-1]:
+                self.length += end - self.ends[-1]
+                self.ends[-1] = end
+            return
+        # Merge with all overlapping or adjacent ranges.
+        low = bisect_left(self.ends, start)
+        high = bisect_right(self.starts, end)
+        if low < high:
+            start = min(start, self.starts[low])
+            end = max(end, self.ends[high - 1])
+        self.length -= self._count(low, high)
+        self.starts[low:high] = [start]
+        self.ends[low:high] = [end]
+        self.length += end - start
+
+    def discard_range(self, start, end):
+        if start >= end:
+            return
+        low = bisect_right(self.ends, start)
+        high = bisect_left(self.starts, end)
+        if low >= high:
+            return
+        starts = list()
+        ends = list()
+        if self.starts[low] < start:
+            starts.append(self.starts[low])
+            ends.append(start)
+        if self.ends[high - 1] > end:
+            starts.append(end)
+            ends.append(self.ends[high - 1])
+        self.length -= self._count(low, high)
+        self.starts[low:high] = starts
+        self.ends[low:high] = ends
+        self.length += sum(e - s for s, e in zip(starts, ends))
+
+    def _count(self, low, high):
+        return sum(self.ends[i] - self.starts[i] for i in range(low, high))
+
+    def run_end(self, index):
+        """ Returns the end of the range containing index, or index itself
+            when it is not part of the set."""
+        position = bisect_right(self.starts, index) - 1
+        if position >= 0 and index < self.ends[position]:
+            return self.ends[position]
+        return index
+
+    def count_in(self, start, end):
+        """ Counts the indexes in the set which fall into [start, end). """
+        low = bisect_right(self.ends, start)
+        high = bisect_left(self.starts, end)
+        return sum(min(self.ends[i], end) - max(self.starts[i], start)
+                   for i in range(low, high))
+
+    def mask(self, indexes):
+        """ Vectorized membership test, returns a boolean numpy array which
+            is True for the indexes in the set."""
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if not self.starts:
+            return np.zeros(indexes.shape, dtype=bool)
+        starts = np.asarray(self.starts, dtype=np.int64)
+        ends = np.asarray(self.ends, dtype=np.int64)
+        positions = np.searchsorted(starts, indexes, side='right') - 1
+        return (positions >= 0) & (indexes < ends[np.maximum(positions, 0)])
+
+    def ranges(self):
+        return [[start, end] for start, end in zip(self.starts, self.ends)]
+
+    def clear(self):
+        self.starts.clear()
+        self.ends.clear()
+        self.length = 0
+
+    def __contains__(self, index):
+        return self.run_end(index) != index
+
+    def __iter__(self):
+        for start, end in zip(self.starts, self.ends):
+            yield from range(start, end)
+
+    def __len__(self):
+        return self.length
+
+
+class DurabilityPolicy(object):
+    """
+    Decides when the buffered writes of a Manifest are committed. \n
+    record:   commit after every record, like earlier versions did.
+    count:    commit every `every_n` records.
+    interval: commit once `interval_ms` elapsed since the last commit. The
+              check runs when records are written, there is no timer thread.
+    close:    only commit when the Manifest is closed. \n
+    Batched modes flush catalogs and their indexes on commit only, and fsync
+    them to disk. Records which were not committed before a crash are
+    recovered from the catalogs when the Manifest is opened again, as long
+    as they made it to the file.
+    """
+
+    RECORD = 'record'
+    COUNT = 'count'
+    INTERVAL = 'interval'
+    CLOSE = 'close'
+    MODES = (RECORD, COUNT, INTERVAL, CLOSE)
+
+    def __init__(self, mode='record', every_n=100, interval_ms=1000):
+        if mode not in DurabilityPolicy.MODES:
+            raise ValueError(f'Unknown durability mode {mode}, expected one '
+                             f'of {DurabilityPolicy.MODES}')
+        self.mode = mode
+        self.every_n = every_n
+        self.interval_ms = interval_ms
+
+    def is_batched(self):
+        return self.mode != DurabilityPolicy.RECORD
+
+    def should_commit(self, pending_records, last_commit_time):
+        if self.mode == DurabilityPolicy.RECORD:
+            return True
+        elif self.mode == DurabilityPolicy.COUNT:
+            return pending_records >= self.every_n
+        elif self.mode == DurabilityPolicy.INTERVAL:
+            elapsed_ms = (time.monotonic() - last_commit_time) * 1000
+            return elapsed_ms >= self.interval_ms
+        return False
 
 
 class Manifest(object):
@@ -223,10 +896,15 @@ class Manifest(object):
     [ json object with user metadata ]\n
     [ json object with manifest metadata ]\n
     [ json object with catalog metadata ]\n
+
+    The manifest metadata describes the record codec of the catalogs, the
+    record_codec argument only applies to new manifests. session_id
+    continues a session of the metadata instead of starting a new one.
     '''
 
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_len=1000, read_only=False):
+                 max_len=1000, read_only=False, durability=None,
+                 max_open_catalogs=8, record_codec='json', session_id=None):
         self.base_path = Path(os.path.expanduser(base_path)).absolute()
         self.manifest_path = Path(os.path.join(self.base_path, 'manifest.json'))
         self.inputs = inputs
@@ -239,8 +917,22 @@ class Manifest(object):
         self.current_index = 0
         self.catalog_paths = list()
         self.catalog_metadata = dict()
-        self.deleted_indexes = set()
+        self.deleted_indexes = IndexRanges()
+        self.durability = durability if durability is not None \
+            else DurabilityPolicy()
+        self._pending_records = 0
+        self._metadata_dirty = False
+        self._last_commit_time = time.monotonic()
         self._updated_session = False
+        # Read only catalog handles used for random access, least recently
+        # used first. Threads share them, the lock guards the cache and the
+        # pins, reads themselves are positional and run outside of it.
+        # Catalogs evicted while pinned are closed by their last reader.
+        self.max_open_catalogs = max_open_catalogs
+        self._catalog_readers = OrderedDict()
+        self._readers_lock = threading.Lock()
+        self._catalog_pins = dict()
+        self._evicted_catalogs = set()
         has_catalogs = False
 
         if self.manifest_path.exists():
@@ -252,11 +944,15 @@ class Manifest(object):
         else:
             created_at = time.time()
             self.manifest_metadata['created_at'] = created_at
+            self.manifest_metadata['record_codec'] = create_record_codec(
+                record_codec, self.inputs, self.types).describe()
             if not self.base_path.exists():
                 self.base_path.mkdir(parents=True, exist_ok=True)
                 print(f'Created a new datastore at {self.base_path.as_posix()}')
             self.seekeable = Seekable(self.manifest_path, read_only=self.read_only)
 
+        self.record_codec = record_codec_from_description(
+            self.manifest_metadata.get('record_codec'))
         if not has_catalogs:
             self._write_contents()
             self._add_catalog()
@@ -266,21 +962,35 @@ class Manifest(object):
             print(f'Using catalog {last_known_catalog}')
             self.current_catalog = Catalog(last_known_catalog,
                                            read_only=self.read_only,
-                                           start_index=self.current_index)
+                                           start_index=self.current_index,
+                                           auto_flush=self._auto_flush(),
+                                           record_codec=self.record_codec)
+            self._recover_current_index()
+            if not self.read_only:
+                self._migrate_catalogs()
         # Create a new session_id, which will be added to each record in the
-        # tub, when Tub.write_record() is called.
-        self.session_id = self.create_new_session()
+        # tub, when Tub.write_record() is called. A session which is already
+        # in the metadata can be continued, like after a compaction.
+        if session_id is not None:
+            self.session_id = session_id
+        else:
+            self.session_id = self.create_new_session()
 
     def write_record(self, record):
-        new_catalog = self.current_index > 0 \
-                      and (self.current_index % self.max_len) == 0
+        # The current catalog decides, a catalog which was committed empty
+        # before a crash is filled again instead of being skipped.
+        new_catalog = self.current_index >= \
+            self.current_catalog.manifest.start_index() + self.max_len
         if new_catalog:
             self._add_catalog()
 
         self.current_catalog.write_record(record)
         self.current_index += 1
-        # Update metadata to keep track of the last index
-        self._update_catalog_metadata(update=True)
+        # Update metadata to keep track of the last index, when the
+        # durability policy asks for it.
+        self._pending_records += 1
+        self._metadata_dirty = True
+        self._commit_if_needed()
         # Set session_id update status to True if this method is called at
         # least once. Then session id metadata  will be updated when the
         # session gets closed
@@ -289,27 +999,246 @@ class Manifest(object):
 
     def delete_record(self, record_index):
         # Does not actually delete the record, but marks it as deleted.
-        self.deleted_indexes.add(record_index)
-        self._update_catalog_metadata(update=True)
+        self.delete_range(record_index, record_index + 1)
 
     def restore_record(self, record_index):
         # Does not actually delete the record, but marks it as deleted.
-        self.deleted_indexes.discard(record_index)
-        self._update_catalog_metadata(update=True)
+        self.restore_range(record_index, record_index + 1)
+
+    def delete_range(self, start, end):
+        """ Marks the records in [start, end) as deleted, with a single
+            metadata update."""
+        self.delete_ranges([(start, end)])
+
+    def restore_range(self, start, end):
+        """ Restores the deleted records in [start, end). """
+        self.restore_ranges([(start, end)])
+
+    def delete_ranges(self, ranges):
+        """ Marks the records of every [start, end) range as deleted, with
+            a single metadata update."""
+        for start, end in ranges:
+            self.deleted_indexes.add_range(max(start, 0),
+                                           min(end, self.current_index))
+        self._metadata_dirty = True
+        self._commit_if_needed()
+
+    def restore_ranges(self, ranges):
+        for start, end in ranges:
+            self.deleted_indexes.discard_range(start, end)
+        self._metadata_dirty = True
+        self._commit_if_needed()
+
+    def read_record(self, record_index, include_deleted=False):
+        """ Reads a single record, straight from its line offset. Raises an
+            IndexError when the record does not exist or has been deleted,
+            unless include_deleted is True."""
+        if record_index < 0:
+            record_index += self.current_index
+        if not 0 <= record_index < self.current_index:
+            raise IndexError(f'Record index {record_index} out of range')
+        if not include_deleted and record_index in self.deleted_indexes:
+            raise IndexError(f'Record {record_index} has been deleted')
+        return self.record_codec.decode(self._read_line(record_index))
+
+    def read_records(self, record_indexes, include_deleted=False):
+        """ Reads records in the given order. A range of records is read
+            with a single read per catalog. """
+        if not (isinstance(record_indexes, range)
+                and record_indexes.step == 1 and len(record_indexes) > 0):
+            return [self.read_record(index, include_deleted=include_deleted)
+                    for index in record_indexes]
+        start, end = record_indexes.start, record_indexes.stop
+        if start < 0 or end > self.current_index:
+            raise IndexError(f'Records {start} to {end} out of range')
+        if not include_deleted and \
+                self.deleted_indexes.count_in(start, end) > 0:
+            raise IndexError(f'Records {start} to {end} have been deleted')
+        records = list()
+        while start < end:
+            catalog_number = start // self.max_len
+            catalog_end = min(end, (catalog_number + 1) * self.max_len)
+            catalog = self._pin_catalog(catalog_number)
+            try:
+                first = start - catalog.manifest.start_index() + 1
+                lines = catalog.read_lines(
+                    range(first, first + catalog_end - start))
+            finally:
+                self._unpin_catalog(catalog)
+            records.extend(self.record_codec.decode(line) for line in lines)
+            start = catalog_end
+        return records
+
+    def _read_line(self, record_index):
+        catalog = self._pin_catalog(record_index // self.max_len)
+        try:
+            line_number = record_index - catalog.manifest.start_index() + 1
+            if not 0 < line_number <= catalog.seekable.lines():
+                raise IndexError(f'Record {record_index} is missing from '
+                                 f'{catalog.path.name}')
+            return catalog.read_line(line_number)
+        finally:
+            self._unpin_catalog(catalog)
+
+    def _pin_catalog(self, catalog_number):
+        """ A catalog to read from, open until it is unpinned. """
+        with self._readers_lock:
+            catalog = self._catalog_reader(catalog_number)
+            pins = self._catalog_pins.get(catalog, 0)
+            self._catalog_pins[catalog] = pins + 1
+            return catalog
+
+    def _unpin_catalog(self, catalog):
+        with self._readers_lock:
+            pins = self._catalog_pins.pop(catalog) - 1
+            if pins > 0:
+                self._catalog_pins[catalog] = pins
+            elif catalog in self._evicted_catalogs:
+                self._evicted_catalogs.discard(catalog)
+                catalog.close()
+
+    def _release_catalog(self, catalog):
+        # Called with the readers lock held
+        if catalog in self._catalog_pins:
+            self._evicted_catalogs.add(catalog)
+        else:
+            catalog.close()
+
+    def view(self, record_indexes=None):
+        """ Returns a lazy view over the given record indexes, or over all
+            records when no indexes are given."""
+        if record_indexes is None:
+            record_indexes = range(self.current_index)
+        return ManifestView(self, record_indexes)
+
+    def _catalog_reader(self, catalog_number):
+        if not 0 <= catalog_number < len(self.catalog_paths):
+            raise IndexError(f'Catalog {catalog_number} does not exist')
+        if catalog_number == len(self.catalog_paths) - 1:
+            return self.current_catalog
+        catalog = self._catalog_readers.pop(catalog_number, None)
+        if catalog is None:
+            catalog_path = os.path.join(self.base_path,
+                                        self.catalog_paths[catalog_number])
+            catalog = Catalog(catalog_path, read_only=True)
+            if len(self._catalog_readers) >= self.max_open_catalogs:
+                _, evicted = self._catalog_readers.popitem(last=False)
+                self._release_catalog(evicted)
+        self._catalog_readers[catalog_number] = catalog
+        return catalog
+
+    def _close_catalog_readers(self):
+        with self._readers_lock:
+            for catalog in self._catalog_readers.values():
+                self._release_catalog(catalog)
+            self._catalog_readers.clear()
+
+    def commit(self):
+        """ Flushes buffered records and writes the catalog metadata. Batched
+            durability policies also fsync the files."""
+        fsync = self.durability.is_batched()
+        if self.current_catalog:
+            self.current_catalog.flush(fsync=fsync)
+        if self._metadata_dirty:
+            self._update_catalog_metadata(update=True)
+            self.seekeable.flush(fsync=fsync)
+        self._pending_records = 0
+        self._metadata_dirty = False
+        self._last_commit_time = time.monotonic()
+
+    def _commit_if_needed(self):
+        if self.durability.should_commit(self._pending_records,
+                                         self._last_commit_time):
+            self.commit()
+
+    def _auto_flush(self):
+        return not self.durability.is_batched()
+
+    def _recover_current_index(self):
+        # Catalogs are the source of truth, the metadata might be behind when
+        # records were not committed before the process went away.
+        while True:
+            catalog_name = f'catalog_{len(self.catalog_paths)}.catalog'
+            catalog_path = Path(os.path.join(self.base_path, catalog_name))
+            catalog_manifest = catalog_path.with_suffix('.catalog_manifest')
+            if not (catalog_path.exists() and catalog_manifest.exists()):
+                break
+            print(f'Recovered catalog {catalog_path.as_posix()}')
+            self.current_catalog.close()
+            self.current_catalog = Catalog(catalog_path,
+                                           read_only=self.read_only,
+                                           auto_flush=self._auto_flush(),
+                                           record_codec=self.record_codec)
+            self.catalog_paths.append(catalog_name)
+        catalog = self.current_catalog
+        # A write cut short by a power cut leaves a line without a newline
+        if not self.read_only and \
+                catalog.seekable.truncate_unterminated_line():
+            print(f'Removed a partial record from {catalog.path.name}')
+        current_index = catalog.manifest.start_index() + \
+            catalog.seekable.lines()
+        if current_index != self.current_index:
+            print(f'Recovered current index {current_index}, metadata had '
+                  f'{self.current_index}')
+            self.current_index = current_index
+            self._metadata_dirty = True
+        if self._metadata_dirty and not self.read_only:
+            self.commit()
+
+    def _migrate_catalogs(self):
+        # Complete catalogs are only opened read only, the line index of
+        # catalogs written by older versions is written here, once.
+        for catalog_name in self.catalog_paths[:-1]:
+            catalog_path = Path(os.path.join(self.base_path, catalog_name))
+            if not (catalog_path.exists() and
+                    catalog_path.with_suffix('.catalog_manifest').exists()):
+                continue
+            if catalog_path.with_suffix('.catalog_index').exists():
+                continue
+            Catalog(catalog_path, record_codec=self.record_codec).close()
 
     def _add_catalog(self):
         current_length = len(self.catalog_paths)
         catalog_name = f'catalog_{current_length}.catalog'
         catalog_path = os.path.join(self.base_path, catalog_name)
         current_catalog = self.current_catalog
+        if current_catalog:
+            current_catalog.flush(fsync=self.durability.is_batched())
         self.current_catalog = Catalog(catalog_path,
                                        start_index=self.current_index,
-                                       read_only=self.read_only)
-        # Store relative paths
+                                       read_only=self.read_only,
+                                       auto_flush=self._auto_flush(),
+                                       record_codec=self.record_codec)
+        # Store relative paths, new catalogs are always committed right away
         self.catalog_paths.append(catalog_name)
-        self._update_catalog_metadata(update=True)
+        self._metadata_dirty = True
+        self.commit()
         if current_catalog:
-            current_catalog.close()
+            with self._readers_lock:
+                self._release_catalog(current_catalog)
+        # The previous catalog is complete now, so it is read through a read
+        # only handle from now on.
+        self._close_catalog_readers()
+
+    def reload(self):
+        """ Re-reads the catalog metadata of a read only manifest, which is
+            being written by another process. Keeps the previous state when
+            the metadata is caught in the middle of an update."""
+        if not self.read_only:
+            raise RuntimeError(f'Manifest {self.manifest_path.as_posix()} '
+                               f'is not read-only, it can not be reloaded.')
+        previous = self.seekeable
+        self.seekeable = Seekable(self.manifest_path, read_only=True)
+        try:
+            if self.seekeable.has_content():
+                self._read_contents()
+                previous.close()
+                return True
+        except ValueError:
+            print(f'Could not reload {self.manifest_path.as_posix()}')
+        self.seekeable.close()
+        self.seekeable = previous
+        return False
 
     def _read_metadata(self, metadata=[]):
         self.metadata = dict()
@@ -327,7 +1256,8 @@ class Manifest(object):
         self.catalog_paths = catalog_metadata['paths']
         self.current_index = catalog_metadata['current_index']
         self.max_len = catalog_metadata['max_len']
-        self.deleted_indexes = set(catalog_metadata['deleted_indexes'])
+        self.deleted_indexes = IndexRanges.from_catalog_metadata(
+            catalog_metadata)
 
     def _write_contents(self):
         self.seekeable.truncate_until_end(0)
@@ -345,7 +1275,7 @@ class Manifest(object):
         catalog_metadata['paths'] = self.catalog_paths
         catalog_metadata['current_index'] = self.current_index
         catalog_metadata['max_len'] = self.max_len
-        catalog_metadata['deleted_indexes'] = list(self.deleted_indexes)
+        catalog_metadata['deleted_ranges'] = self.deleted_indexes.ranges()
         self.catalog_metadata = catalog_metadata
         self.seekeable.writeline(json.dumps(catalog_metadata))
 
@@ -371,19 +1301,70 @@ class Manifest(object):
             manifest.json"""
         # If records were received, write updated session_id dictionary into
         # the metadata, otherwise keep the session_id information unchanged
+        if not self.read_only:
+            self.commit()
         if self._updated_session:
             self.seekeable.update_line(4, json.dumps(self.manifest_metadata))
+        self._close_catalog_readers()
         self.current_catalog.close()
         self.seekeable.close()
 
     def __iter__(self):
         return ManifestIterator(self)
 
+    def follow(self, poll_interval=0.05, timeout=None):
+        """ Follows the records as they are written. A manifest open for
+            writing is followed through a read only manifest of its own,
+            which sees the records once they are flushed. """
+        if self.read_only:
+            return ManifestFollower(self, poll_interval=poll_interval,
+                                    timeout=timeout)
+        manifest = Manifest(self.base_path, read_only=True)
+        return ManifestFollower(manifest, poll_interval=poll_interval,
+                                timeout=timeout, close_manifest=True)
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return self.view(range(*item.indices(self.current_index)))
+        return self.read_record(item)
+
     def __len__(self):
         # current_index is already pointing to the next index
         return self.current_index - len(self.deleted_indexes)
 
 
+class ManifestView(object):
+    """
+    A lazy view over a subset of the records in a Manifest. \n
+    The view only holds record indexes, records are read when they are
+    accessed. Indexes which are marked deleted are left out of the view.
+    """
+    def __init__(self, manifest, record_indexes):
+        self.manifest = manifest
+        deleted_indexes = manifest.deleted_indexes
+        if isinstance(record_indexes, range) and record_indexes.step == 1 \
+                and deleted_indexes.count_in(record_indexes.start,
+                                             record_indexes.stop) == 0:
+            self.indexes = record_indexes
+        else:
+            indexes = np.asarray(record_indexes, dtype=np.int64)
+            if len(deleted_indexes) > 0:
+                indexes = indexes[~deleted_indexes.mask(indexes)]
+            self.indexes = indexes
+
+    def __getitem__(self, item):
+        if isinstance(item, slice):
+            return ManifestView(self.manifest, self.indexes[item])
+        return self.manifest.read_record(self.indexes[item])
+
+    def __iter__(self):
+        for index in self.indexes:
+            yield self.manifest.read_record(index)
+
+    def __len__(self):
+        return len(self.indexes)
+
+
 class ManifestIterator(object):
     """
     An iterator for the Manifest type. \n
@@ -392,16 +1373,31 @@ class ManifestIterator(object):
     """
     def __init__(self, manifest):
         self.manifest = manifest
+        # Catalogs are read through their own read only handles, make sure
+        # they see records which are still buffered by the writer.
+        if not self.manifest.read_only and self.manifest.current_catalog:
+            self.manifest.current_catalog.flush()
         self.has_catalogs = len(self.manifest.catalog_paths) > 0
         self.current_index = 0
         self.current_catalog_index = 0
         self.current_catalog = None
+        # Line of the next record in the current catalog
+        self.line_number = 1
+
+    def __iter__(self):
+        return self
 
     def __next__(self):
         while True:
             if not self.has_catalogs:
                 raise StopIteration('No catalogs')
 
+            # Skip over whole runs of records marked deleted at once.
+            next_index = self.manifest.deleted_indexes.run_end(
+                self.current_index)
+            if next_index != self.current_index:
+                self._skip_to(next_index)
+
             if self.current_catalog_index >= len(self.manifest.catalog_paths):
                 raise StopIteration('No more catalogs')
 
@@ -410,30 +1406,151 @@ class ManifestIterator(object):
                     self.manifest.base_path,
                     self.manifest.catalog_paths[self.current_catalog_index])
                 self.current_catalog = Catalog(current_catalog_path,
-                                               read_only=self.manifest.read_only)
-                self.current_catalog.seekable.seek_line_start(1)
-
-            contents = self.current_catalog.seekable.readline()
+                                               read_only=True)
+                start_index = self.current_catalog.manifest.start_index()
+                self.line_number = max(self.current_index - start_index, 0) + 1
+
+            contents = None
+            if self.line_number <= self.current_catalog.seekable.lines():
+                contents = self.current_catalog.read_line(self.line_number)
+                self.line_number += 1
             if contents is not None and len(contents) > 0:
                 # Check for current_index when we are ready to advance the
                 # underlying iterator.
                 current_index = self.current_index
                 self.current_index += 1
-                if current_index in self.manifest.deleted_indexes:
-                    # Skip over index, because it has been marked deleted
+                try:
+                    record = self.manifest.record_codec.decode(contents)
+                    return record
+                except Exception:
+                    print(f'Ignoring record at index {current_index}')
                     continue
-                else:
-                    try:
-                        record = json.loads(contents)
-                        return record
-                    except Exception:
-                        print(f'Ignoring record at index {current_index}')
-                        continue
             else:
+                self.current_catalog.close()
                 self.current_catalog = None
                 self.current_catalog_index += 1
 
+    def _skip_to(self, record_index):
+        self.current_index = record_index
+        catalog = self.current_catalog
+        if catalog is not None:
+            line_number = record_index - catalog.manifest.start_index() + 1
+            if line_number <= catalog.seekable.lines():
+                self.line_number = line_number
+                return
+            catalog.close()
+            self.current_catalog = None
+        self.current_catalog_index = max(self.current_catalog_index,
+                                         record_index // self.manifest.max_len)
+
     next = __next__
 
     def __len__(self):
         return self.manifest.__len__()
+
+
+class ManifestFollower(object):
+    """
+    Follows a Manifest while it is being written, like `tail -f`. \n
+    Records are returned as soon as their complete line lands in a catalog.
+    The current catalog is polled for growth and only the new part of the
+    file is mapped, manifest.json is reloaded for new catalogs and deleted
+    records. Iteration stops once nothing new arrived for `timeout` seconds,
+    or never when timeout is None. \n
+    The manifest must be read only, with close_manifest it is closed when
+    the iteration stops or close() is called.
+    """
+    def __init__(self, manifest, poll_interval=0.05, timeout=None,
+                 close_manifest=False):
+        self.manifest = manifest
+        self.close_manifest = close_manifest
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.current_index = 0
+        self.catalog_number = 0
+        # Bytes of the current catalog which have been consumed
+        self.offset = 0
+        self.pending = deque()
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        idle_since = time.monotonic()
+        while True:
+            while self.pending:
+                record_index, line = self.pending.popleft()
+                if record_index in self.manifest.deleted_indexes:
+                    continue
+                try:
+                    contents = line.decode('utf-8').rstrip(NEWLINE_STRIP)
+                    return self.manifest.record_codec.decode(contents)
+                except Exception:
+                    print(f'Ignoring record at index {record_index}')
+
+            if self._read_new_lines() or self._next_catalog():
+                idle_since = time.monotonic()
+                continue
+
+            if self.timeout is not None and \
+                    time.monotonic() - idle_since >= self.timeout:
+                self.close()
+                raise StopIteration('No new records')
+            time.sleep(self.poll_interval)
+            self.manifest.reload()
+
+    next = __next__
+
+    def close(self):
+        if self.close_manifest:
+            self.close_manifest = False
+            self.manifest.close()
+
+    def _catalog_path(self, catalog_number):
+        if catalog_number < len(self.manifest.catalog_paths):
+            catalog_name = self.manifest.catalog_paths[catalog_number]
+        else:
+            # Catalogs follow a naming convention, which lets us pick up a
+            # new catalog before the manifest is committed.
+            catalog_name = f'catalog_{catalog_number}.catalog'
+        return os.path.join(self.manifest.base_path, catalog_name)
+
+    def _read_new_lines(self):
+        path = self._catalog_path(self.catalog_number)
+        if not os.path.exists(path):
+            return False
+        size = os.path.getsize(path)
+        if size <= self.offset:
+            return False
+        # Only map the part of the file which has not been consumed yet.
+        map_offset = self.offset - self.offset % mmap.ALLOCATIONGRANULARITY
+        with open(path, 'rb') as file, \
+                mmap.mmap(file.fileno(), length=size - map_offset,
+                          offset=map_offset, access=mmap.ACCESS_READ) as data:
+            start = self.offset - map_offset
+            # Lines without a newline are still being written.
+            end = data.rfind(NEWLINE.encode('utf-8'), start) + 1
+            if end <= 0:
+                return False
+            contents = data[start:end]
+        # Records are split on newlines only, strings encoded by orjson can
+        # hold other line separators, like U+2028.
+        for line in contents.split(NEWLINE.encode('utf-8'))[:-1]:
+            self.pending.append((self.current_index, line))
+            self.current_index += 1
+        self.offset = map_offset + end
+        return True
+
+    def _next_catalog(self):
+        if not os.path.exists(self._catalog_path(self.catalog_number + 1)):
+            return False
+        # Catalogs are complete before the next one is created, consume what
+        # is left before moving on.
+        if self._read_new_lines():
+            return True
+        self.catalog_number += 1
+        self.offset = 0
+        return True
+
+    def __len__(self):
+        return self.manifest.__len__()
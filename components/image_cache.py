@@ -0,0 +1,95 @@
+import threading
+from collections import OrderedDict
+
+
+class ImageCache(object):
+    """
+    A thread safe least recently used cache of decoded images, bounded by
+    the bytes of the cached arrays rather than by their count. \n
+    Keys are (tub path, image reference, (width, height), depth) tuples,
+    size and depth are None for images kept as recorded. One cache can be
+    shared by several tubs, pass it to Tub(image_cache=...). Cached arrays
+    are read only since every reader shares them, copy them to modify
+    them. \n
+    stats() reports the hits, misses and evictions so far, with the number
+    of cached images and their bytes.
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.images = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached image for key, or None. """
+        with self.lock:
+            image = self.images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self.images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        image.setflags(write=False)
+        with self.lock:
+            previous = self.images.pop(key, None)
+            if previous is not None:
+                self.bytes -= previous.nbytes
+            if image.nbytes > self.max_bytes:
+                # Would evict everything else and still not fit
+                return image
+            self.images[key] = image
+            self.bytes += image.nbytes
+            while self.bytes > self.max_bytes:
+                _, evicted = self.images.popitem(last=False)
+                self.bytes -= evicted.nbytes
+                self.evictions += 1
+        return image
+
+    def get_or_load(self, key, load):
+        """
+        Returns the cached image for key, calling load() to decode it on a
+        miss. Threads missing the same key at the same time may both decode
+        it, the lock is not held while decoding.
+        """
+        image = self.get(key)
+        if image is None:
+            image = self.put(key, load())
+        return image
+
+    def stats(self):
+        with self.lock:
+            return {
+                'images': len(self.images),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def discard(self, tub_path):
+        """ Drops the images of a tub, once compact() reused its image
+            references."""
+        with self.lock:
+            for key in [key for key in self.images if key[0] == tub_path]:
+                self.bytes -= self.images.pop(key).nbytes
+
+    def clear(self):
+        with self.lock:
+            self.images.clear()
+            self.bytes = 0
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.images
+
+    def __len__(self):
+        with self.lock:
+            return len(self.images)
@@ -0,0 +1,169 @@
+from io import BytesIO
+
+import numpy as np
+from PIL import Image
+
+try:
+    import cv2
+except ImportError:
+    cv2 = None
+
+
+class JpegCodec(object):
+    """
+    Jpeg through PIL. quality and subsampling are passed to PIL, subsampling
+    0 is 4:4:4, 1 is 4:2:2 and 2 is 4:2:0 (the PIL default).
+    """
+
+    name = 'jpeg'
+    extension = '.jpg'
+
+    def __init__(self, quality=75, subsampling=None):
+        self.quality = quality
+        self.subsampling = subsampling
+
+    def encode(self, image_array):
+        image = Image.fromarray(np.uint8(image_array))
+        options = {'quality': self.quality}
+        if self.subsampling is not None:
+            options['subsampling'] = self.subsampling
+        contents = BytesIO()
+        image.save(contents, format='jpeg', **options)
+        return contents.getvalue()
+
+
+class PngCodec(object):
+    """
+    Lossless png through PIL. The default compress_level of 1 favours
+    encode speed over size.
+    """
+
+    name = 'png'
+    extension = '.png'
+
+    def __init__(self, compress_level=1):
+        self.compress_level = compress_level
+
+    def encode(self, image_array):
+        image = Image.fromarray(np.uint8(image_array))
+        contents = BytesIO()
+        image.save(contents, format='png', compress_level=self.compress_level)
+        return contents.getvalue()
+
+
+class NpyCodec(object):
+    """ Raw arrays in the numpy .npy format, no compression. """
+
+    name = 'npy'
+    extension = '.npy'
+
+    def encode(self, image_array):
+        contents = BytesIO()
+        np.save(contents, np.uint8(image_array), allow_pickle=False)
+        return contents.getvalue()
+
+
+class Cv2JpegCodec(object):
+    """
+    Jpeg through the OpenCV encoder, which is usually faster than PIL.
+    Images are RGB, like the rest of the tub. Needs cv2.
+    """
+
+    name = 'cv2_jpeg'
+    extension = '.jpg'
+
+    def __init__(self, quality=75):
+        if cv2 is None:
+            raise RuntimeError('The cv2_jpeg codec needs OpenCV (cv2).')
+        self.quality = quality
+
+    def encode(self, image_array):
+        image_array = np.uint8(image_array)
+        if image_array.ndim == 3 and image_array.shape[2] == 3:
+            image_array = cv2.cvtColor(image_array, cv2.COLOR_RGB2BGR)
+        success, contents = cv2.imencode(
+            '.jpg', image_array, [int(cv2.IMWRITE_JPEG_QUALITY), self.quality])
+        if not success:
+            raise ValueError('OpenCV could not encode the image')
+        return contents.tobytes()
+
+
+IMAGE_CODECS = {
+    JpegCodec.name: JpegCodec,
+    PngCodec.name: PngCodec,
+    NpyCodec.name: NpyCodec,
+    Cv2JpegCodec.name: Cv2JpegCodec,
+}
+
+
+def available_image_codecs():
+    return [name for name in IMAGE_CODECS
+            if name != Cv2JpegCodec.name or cv2 is not None]
+
+
+def create_image_codec(settings=None):
+    """
+    Creates an image codec from its settings, either a codec name or a dict
+    with a 'codec' name and the options of that codec, for example
+    {'codec': 'jpeg', 'quality': 90, 'subsampling': 0}.
+    """
+    if settings is None:
+        return JpegCodec()
+    if isinstance(settings, str):
+        settings = {'codec': settings}
+    options = dict(settings)
+    name = options.pop('codec', JpegCodec.name)
+    if name not in IMAGE_CODECS:
+        raise ValueError(f'Unknown image codec {name}, expected one of '
+                         f'{list(IMAGE_CODECS)}')
+    return IMAGE_CODECS[name](**options)
+
+
+def decode_image(contents, extension, size=None, depth=None):
+    """
+    Decodes an encoded image into a numpy uint8 array. The codec is picked
+    from the extension of the image file name or blob reference. \n
+    size (width, height) and depth resize and convert the image like
+    utils.load_image, a depth of 1 gives a (H, W, 1) grey scale array.
+    """
+    if extension == NpyCodec.extension:
+        image_array = np.load(BytesIO(contents), allow_pickle=False)
+        if size is None and depth is None:
+            return image_array
+        image = Image.fromarray(image_array)
+    else:
+        image = Image.open(BytesIO(contents))
+        if size is None and depth is None:
+            return np.asarray(image)
+    if size is not None and tuple(size) != image.size:
+        image = image.resize(tuple(size))
+    if depth == 1 and image.mode != 'L':
+        image = image.convert('L')
+    image_array = np.asarray(image)
+    if image_array.ndim == 2:
+        image_array = image_array.reshape(image_array.shape + (1,))
+    return image_array
+
+
+def decode_image_into(contents, extension, out):
+    """
+    Decodes an encoded image straight into out, a (H, W, C) slice of a
+    preallocated batch. Images are resized to (W, H) and converted to grey
+    scale for a single channel, like utils.load_pil_image does. out can be
+    a float array, pixels are copied without scaling.
+    """
+    height, width, depth = out.shape
+    if extension == NpyCodec.extension:
+        image_array = np.load(BytesIO(contents), allow_pickle=False)
+        if image_array.shape[:2] == (height, width):
+            out[...] = image_array.reshape(out.shape)
+            return out
+        image = Image.fromarray(image_array)
+    else:
+        image = Image.open(BytesIO(contents))
+    if image.height != height or image.width != width:
+        image = image.resize((width, height))
+    if depth == 1 and image.mode != 'L':
+        image = image.convert('L')
+    out[...] = np.asarray(image).reshape(out.shape)
+    return out
@@ -0,0 +1,121 @@
+import mmap
+import os
+import re
+from collections import OrderedDict
+
+
+BLOB_EXTENSION = '.images'
+# catalog_3.images@1024:2048.jpg
+BLOB_REFERENCE = re.compile(
+    r'^(?P<blob>[^@/]+)@(?P<offset>\d+):(?P<length>\d+)(?P<extension>\.\w+)?$')
+
+
+def blob_name(catalog_number):
+    """ The blob file which holds the images of a catalog. """
+    return f'catalog_{catalog_number}{BLOB_EXTENSION}'
+
+
+def blob_reference(name, offset, length, extension=''):
+    return f'{name}@{offset}:{length}{extension}'
+
+
+def parse_blob_reference(reference):
+    """
+    Returns (blob name, offset, length, extension) for a blob reference, or
+    None when the reference is an image file name.
+    """
+    match = BLOB_REFERENCE.match(reference)
+    if match is None:
+        return None
+    return (match.group('blob'), int(match.group('offset')),
+            int(match.group('length')), match.group('extension') or '')
+
+
+def image_extension(reference):
+    """ The extension of an image file name or blob reference. """
+    parsed = parse_blob_reference(reference)
+    if parsed is not None:
+        return parsed[3]
+    return os.path.splitext(reference)[1]
+
+
+class ImageBlobWriter(object):
+    """
+    Appends encoded images to one blob file per catalog, next to the
+    catalog_N.catalog files. \n
+    Records store a blob reference, which holds the offset and length of the
+    image. Reading an image is a slice of the memory mapped blob.
+    """
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.catalog_number = None
+        self.file = None
+
+    def append(self, catalog_number, contents, extension=''):
+        if catalog_number != self.catalog_number:
+            self.close()
+            path = os.path.join(self.base_path, blob_name(catalog_number))
+            self.file = open(path, 'ab')
+            self.catalog_number = catalog_number
+        offset = self.file.tell()
+        self.file.write(contents)
+        # The record referencing the image is written right after this.
+        self.file.flush()
+        return blob_reference(blob_name(catalog_number), offset,
+                              len(contents), extension)
+
+    def close(self):
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+            self.file.close()
+            self.file = None
+            self.catalog_number = None
+
+
+class ImageReader(object):
+    """
+    Reads encoded images of a tub, from image files in the images folder or
+    from blob files. Blobs are memory mapped, at most max_open_blobs at a
+    time, and images are returned as zero copy memoryviews.
+    """
+    def __init__(self, base_path, images_path, max_open_blobs=8):
+        self.base_path = base_path
+        self.images_path = images_path
+        self.max_open_blobs = max_open_blobs
+        self.blobs = OrderedDict()
+
+    def read(self, reference):
+        parsed = parse_blob_reference(reference)
+        if parsed is None:
+            with open(os.path.join(self.images_path, reference), 'rb') as file:
+                return file.read()
+        name, offset, length, _ = parsed
+        blob = self._blob(name, offset + length)
+        if offset + length > len(blob):
+            raise ValueError(f'Image {reference} is beyond the end of {name}')
+        return memoryview(blob)[offset:offset + length]
+
+    def path(self, reference):
+        """ The file holding an image. """
+        parsed = parse_blob_reference(reference)
+        if parsed is None:
+            return os.path.join(self.images_path, reference)
+        return os.path.join(self.base_path, parsed[0])
+
+    def _blob(self, name, size):
+        blob = self.blobs.pop(name, None)
+        if blob is None or len(blob) < size:
+            # Blobs of the current catalog grow, map them again.
+            path = os.path.join(self.base_path, name)
+            with open(path, 'rb') as file:
+                blob = mmap.mmap(file.fileno(), length=0,
+                                 access=mmap.ACCESS_READ)
+            if len(self.blobs) >= self.max_open_blobs:
+                # Mapped blobs are unmapped once the last memoryview into
+                # them is released.
+                self.blobs.popitem(last=False)
+        self.blobs[name] = blob
+        return blob
+
+    def close(self):
+        self.blobs.clear()
@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+"""
+Compiles the images of a tub into a memory mapped tensor cache.
+
+Usage: python -m components.tub_cache --tub ~/mycar/data [--image-h 120]
+       [--image-w 160] [--image-depth 3] [--crop-top 0] [--crop-bottom 0]
+       [--normalize]
+"""
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import numpy as np
+
+from components.image_codecs import decode_image_into
+from components.image_store import image_extension
+from components.tub_dataset import LABEL_DTYPES, ONE_BYTE_SCALE
+
+
+CACHE_DIR = 'cache'
+CACHE_STATE = 'cache.json'
+CACHE_IMAGES = 'images.bin'
+# Rows decoded between two flushes of the cache
+BUILD_CHUNK = 256
+
+
+class TubCache(object):
+    """
+    A memory mapped (N, H, W, C) array of the preprocessed images of a tub,
+    with one array per label. Row i holds record i, deleted records
+    included, and indexes lists the rows which are not deleted. \n
+    Images are resized to (image_w, image_h), converted to grey scale for a
+    depth of 1, cropped by crop_top and crop_bottom rows like utils.img_crop
+    and, with normalize, scaled to float32 in [0, 1]. \n
+    The cache lives in a folder named after a hash of these settings, so
+    every preprocessing config gets its own cache. It is current when it
+    holds all records of the tub and the same deleted set. build() decodes
+    only the records added since the last build, a changed deleted set
+    costs no decoding, and a compacted tub is rebuilt from scratch.
+    """
+
+    def __init__(self, tub, image_key='cam/image_array',
+                 label_keys=('user/angle', 'user/throttle'), image_h=120,
+                 image_w=160, image_depth=3, crop_top=0, crop_bottom=0,
+                 normalize=False, cache_path=None):
+        self.tub = tub
+        self.config = {
+            'image_key': image_key,
+            'label_keys': list(label_keys),
+            'image_h': image_h,
+            'image_w': image_w,
+            'image_depth': image_depth,
+            'crop_top': crop_top,
+            'crop_bottom': crop_bottom,
+            'normalize': normalize,
+        }
+        contents = json.dumps(self.config, sort_keys=True).encode('utf-8')
+        self.config_hash = hashlib.sha1(contents).hexdigest()[:16]
+        if cache_path is None:
+            cache_path = os.path.join(tub.manifest.base_path.as_posix(),
+                                      CACHE_DIR, self.config_hash)
+        self.cache_path = cache_path
+        self.state_path = os.path.join(cache_path, CACHE_STATE)
+        self.images_path = os.path.join(cache_path, CACHE_IMAGES)
+        self.dtype = np.dtype(np.float32 if normalize else np.uint8)
+        self.image_shape = (image_h - crop_top - crop_bottom, image_w,
+                            image_depth)
+        self.frame_bytes = int(np.prod(self.image_shape)) * self.dtype.itemsize
+        input_types = dict(zip(tub.manifest.inputs, tub.manifest.types))
+        self.label_dtypes = {key: LABEL_DTYPES.get(input_types.get(key),
+                                                   np.object_)
+                             for key in self.config['label_keys']}
+        if any(dtype is np.object_ for dtype in self.label_dtypes.values()):
+            raise ValueError('Only float, int and boolean labels can be '
+                             'cached')
+        self.state = self._read_state()
+        self.images = None
+        self.labels = None
+        self.indexes = None
+
+    def _read_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, 'r') as file:
+            state = json.load(file)
+        if state.get('config') != self.config \
+                or state.get('generation') != self._generation():
+            return None
+        return state
+
+    def _write_state(self, state):
+        # Written last and replaced atomically, so a build interrupted by a
+        # crash resumes from the previous state.
+        temporary_path = self.state_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write(json.dumps(state))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, self.state_path)
+        self.state = state
+
+    def _generation(self):
+        """ Changes whenever the record indexes of the tub change. """
+        metadata = self.tub.manifest.manifest_metadata
+        return [metadata.get('created_at'), metadata.get('compacted_at')]
+
+    def _label_path(self, position):
+        return os.path.join(self.cache_path, f'label_{position}.npy')
+
+    @property
+    def key(self):
+        """ Identifies the preprocessing config, records and deleted set. """
+        manifest = self.tub.manifest
+        deleted = json.dumps(manifest.deleted_indexes.ranges())
+        deleted_hash = hashlib.sha1(deleted.encode('utf-8')).hexdigest()[:16]
+        return f'{self.config_hash}-{manifest.current_index}-{deleted_hash}'
+
+    def is_current(self):
+        return self.state is not None and self.state['key'] == self.key
+
+    def build(self):
+        """
+        Brings the cache up to date with the tub, decoding only the records
+        it does not hold yet. Returns the number of decoded records.
+        """
+        manifest = self.tub.manifest
+        if manifest.current_index == 0:
+            raise ValueError(f'Tub {self.tub.base_path} has no records')
+        self.close()
+        os.makedirs(self.cache_path, exist_ok=True)
+        rows = self.state['rows'] if self.state is not None else 0
+        target = manifest.current_index
+        if rows > target:
+            rows = 0
+        labels = {key: np.load(self._label_path(position))[:rows]
+                  if rows > 0 else np.empty(0, dtype=dtype)
+                  for position, (key, dtype)
+                  in enumerate(self.label_dtypes.items())}
+        new_labels = {key: np.empty(target - rows, dtype=dtype)
+                      for key, dtype in self.label_dtypes.items()}
+        with open(self.images_path, 'ab') as file:
+            # Drops rows appended after the last recorded state.
+            file.truncate(rows * self.frame_bytes)
+            batch = np.empty((BUILD_CHUNK,) + self.image_shape,
+                             dtype=self.dtype)
+            for start in range(rows, target, BUILD_CHUNK):
+                end = min(start + BUILD_CHUNK, target)
+                records = manifest.read_records(range(start, end),
+                                                include_deleted=True)
+                for position, record in enumerate(records):
+                    self._preprocess(record, batch[position])
+                    for key in self.label_dtypes:
+                        new_labels[key][start - rows + position] = \
+                            record.get(key, 0)
+                file.write(batch[:end - start].tobytes())
+            file.flush()
+            os.fsync(file.fileno())
+        for position, key in enumerate(self.label_dtypes):
+            np.save(self._label_path(position),
+                    np.concatenate([labels[key], new_labels[key]]))
+        self._write_state({
+            'config': self.config,
+            'generation': self._generation(),
+            'rows': target,
+            'key': self.key,
+            'built_at': time.time(),
+        })
+        return target - rows
+
+    def _preprocess(self, record, out):
+        image_h, image_w = self.config['image_h'], self.config['image_w']
+        crop_top = self.config['crop_top']
+        reference = record.get(self.config['image_key'])
+        if reference is None:
+            out[...] = 0
+            return
+        try:
+            contents = self.tub.read_image(reference)
+        except OSError as exception:
+            print(f'Missing image {reference}: {exception}')
+            out[...] = 0
+            return
+        image = np.empty((image_h, image_w, self.config['image_depth']),
+                         dtype=np.uint8)
+        decode_image_into(contents, image_extension(reference), image)
+        cropped = image[crop_top:crop_top + self.image_shape[0]]
+        if self.config['normalize']:
+            np.multiply(cropped, ONE_BYTE_SCALE, out=out, casting='unsafe')
+        else:
+            out[...] = cropped
+
+    def open(self):
+        """
+        Maps the cache, building it first when it is not current. The images
+        and labels are read only memory maps.
+        """
+        if not self.is_current():
+            self.build()
+        rows = self.state['rows']
+        self.images = np.memmap(self.images_path, dtype=self.dtype, mode='r',
+                                shape=(rows,) + self.image_shape)
+        self.labels = {key: np.load(self._label_path(position),
+                                    mmap_mode='r')
+                       for position, key in enumerate(self.label_dtypes)}
+        deleted = self.tub.manifest.deleted_indexes
+        indexes = np.arange(rows, dtype=np.int64)
+        self.indexes = indexes[~deleted.mask(indexes)]
+        return self
+
+    def batches(self, batch_size=64, shuffle=True, seed=None,
+                drop_last=False, augmentation=None):
+        """
+        Yields (images, labels) batches like TubDataset, gathered from the
+        memory map into buffers which are reused by the next batch.
+        augmentation is called on every batch before it is yielded.
+        """
+        if self.images is None:
+            self.open()
+        indexes = self.indexes
+        if shuffle:
+            indexes = np.random.default_rng(seed).permutation(indexes)
+        images = np.empty((batch_size,) + self.image_shape, dtype=self.dtype)
+        labels = {key: np.empty(batch_size, dtype=dtype)
+                  for key, dtype in self.label_dtypes.items()}
+        for start in range(0, len(indexes), batch_size):
+            batch_indexes = indexes[start:start + batch_size]
+            count = len(batch_indexes)
+            if count < batch_size and drop_last:
+                break
+            np.take(self.images, batch_indexes, axis=0, out=images[:count])
+            for key, values in self.labels.items():
+                np.take(values, batch_indexes, out=labels[key][:count])
+            batch_images = images[:count]
+            batch_labels = {key: value[:count]
+                            for key, value in labels.items()}
+            if augmentation is not None:
+                batch_images, batch_labels = augmentation(batch_images,
+                                                          batch_labels)
+            yield batch_images, batch_labels
+
+    def close(self):
+        self.images = None
+        self.labels = None
+        self.indexes = None
+
+    def __len__(self):
+        if self.indexes is None:
+            self.open()
+        return len(self.indexes)
+
+
+def main():
+    from components.tub_v2 import Tub
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tub', required=True)
+    parser.add_argument('--image-key', default='cam/image_array')
+    parser.add_argument('--labels', nargs='+',
+                        default=['user/angle', 'user/throttle'])
+    parser.add_argument('--image-h', type=int, default=120)
+    parser.add_argument('--image-w', type=int, default=160)
+    parser.add_argument('--image-depth', type=int, default=3)
+    parser.add_argument('--crop-top', type=int, default=0)
+    parser.add_argument('--crop-bottom', type=int, default=0)
+    parser.add_argument('--normalize', action='store_true')
+    args = parser.parse_args()
+
+    tub = Tub(args.tub, read_only=True)
+    cache = TubCache(tub, image_key=args.image_key, label_keys=args.labels,
+                     image_h=args.image_h, image_w=args.image_w,
+                     image_depth=args.image_depth, crop_top=args.crop_top,
+                     crop_bottom=args.crop_bottom, normalize=args.normalize)
+    if cache.is_current():
+        print(f'Cache {cache.cache_path} is up to date')
+    else:
+        start = time.perf_counter()
+        decoded = cache.build()
+        print(f'Decoded {decoded} records into {cache.cache_path} in '
+              f'{time.perf_counter() - start:.1f}s')
+    tub.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,185 @@
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from components.datastore_v2 import IndexRanges, read_manifest_file
+from components.tub_split import SPLIT_BLOCK, SPLIT_RECORD, block_groups, \
+    split_indexes
+from components.tub_v2 import Tub
+
+
+SPLIT_TUB = 'tub'
+
+
+class TubCollection(object):
+    """
+    Many tubs seen as one dataset, with a global index over the records of
+    all of them, deleted records excluded. \n
+    Opening a collection only reads the catalog metadata line of each
+    manifest.json, which holds the record count and deleted ranges, and
+    builds a prefix sum over the tub lengths. Global indexes are mapped to
+    (tub, record index) with binary searches. Tubs are opened read only on
+    first access and at most max_open_tubs stay open, least recently used
+    first, each with at most max_open_catalogs catalog readers. \n
+    Records returned by the collection carry a _tub key, the position of
+    their tub in paths, which load_image() uses. Records written after the
+    collection was opened are not part of it.
+    """
+
+    MANIFEST = 'manifest.json'
+
+    def __init__(self, paths, max_open_tubs=4, max_open_catalogs=2):
+        self.paths = [os.path.expanduser(path) for path in paths]
+        self.max_open_tubs = max_open_tubs
+        self.max_open_catalogs = max_open_catalogs
+        self.tubs = OrderedDict()
+        # Per tub, the record index where every run of kept records starts
+        # and the number of kept records before it.
+        self.run_starts = list()
+        self.run_offsets = list()
+        lengths = list()
+        for path in self.paths:
+            current_index, deleted = TubCollection._read_catalog_metadata(path)
+            # Legacy manifests can list deleted indexes past current_index
+            starts = np.clip(deleted.starts, 0, current_index)
+            ends = np.clip(deleted.ends, 0, current_index)
+            kept_starts = np.concatenate(([0], ends)).astype(np.int64)
+            kept_ends = np.concatenate((starts, [current_index]))
+            sizes = np.maximum(np.subtract(kept_ends, kept_starts), 0)
+            self.run_starts.append(kept_starts)
+            self.run_offsets.append(np.concatenate(([0], np.cumsum(sizes))))
+            lengths.append(int(sizes.sum()))
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.concatenate(([0], np.cumsum(self.lengths)))
+
+    @classmethod
+    def from_datastore(cls, root, **kwargs):
+        """
+        Collects every tub below root, like the ~/datastore/<date>/<n>/
+        folders created by drive(), in path order with numbered folders
+        sorted by number.
+        """
+        paths = list()
+        for directory, directories, files in os.walk(os.path.expanduser(root)):
+            if TubCollection.MANIFEST in files:
+                paths.append(directory)
+                # Tubs are not nested
+                directories.clear()
+        return cls(sorted(paths, key=TubCollection._path_key), **kwargs)
+
+    @staticmethod
+    def _path_key(path):
+        return [(0, int(part), '') if part.isdigit() else (1, 0, part)
+                for part in path.split(os.sep)]
+
+    @classmethod
+    def _read_catalog_metadata(cls, path):
+        """ The current index and deleted records of a tub, from the fifth
+            line of its manifest. """
+        _, lines = read_manifest_file(os.path.join(path,
+                                                   TubCollection.MANIFEST))
+        catalog_metadata = lines[4]
+        return catalog_metadata['current_index'], \
+            IndexRanges.from_catalog_metadata(catalog_metadata)
+
+    def locate(self, indexes):
+        """ Maps global indexes to (tub numbers, record indexes) arrays. """
+        indexes = np.asarray(indexes, dtype=np.int64)
+        if indexes.size and (indexes.min() < 0 or indexes.max() >= len(self)):
+            raise IndexError(f'Index out of range for {len(self)} records')
+        tub_numbers = np.searchsorted(self.offsets, indexes, side='right') - 1
+        positions = indexes - self.offsets[tub_numbers]
+        record_indexes = np.empty_like(positions)
+        for tub_number in np.unique(tub_numbers):
+            selected = tub_numbers == tub_number
+            offsets = self.run_offsets[tub_number]
+            runs = np.searchsorted(offsets, positions[selected],
+                                   side='right') - 1
+            record_indexes[selected] = self.run_starts[tub_number][runs] \
+                + positions[selected] - offsets[runs]
+        return tub_numbers, record_indexes
+
+    def tub(self, tub_number):
+        """ The tub with the given number, opened read only on demand. """
+        tub = self.tubs.pop(tub_number, None)
+        if tub is None:
+            if len(self.tubs) >= self.max_open_tubs:
+                _, closed = self.tubs.popitem(last=False)
+                closed.close()
+            tub = Tub(self.paths[tub_number], read_only=True,
+                      max_open_catalogs=self.max_open_catalogs)
+        self.tubs[tub_number] = tub
+        return tub
+
+    def get_records(self, indexes):
+        """ Reads the records with the given global indexes, in the given
+            order. Records are read a tub at a time. """
+        tub_numbers, record_indexes = self.locate(indexes)
+        records = [None] * len(record_indexes)
+        for tub_number in np.unique(tub_numbers):
+            positions = np.flatnonzero(tub_numbers == tub_number)
+            tub = self.tub(int(tub_number))
+            tub_records = tub.get_records(record_indexes[positions].tolist())
+            for position, record in zip(positions, tub_records):
+                record['_tub'] = int(tub_number)
+                records[position] = record
+        return records
+
+    def load_image(self, record, key='cam/image_array'):
+        return self.tub(record['_tub']).load_image(record[key])
+
+    def indexes(self, shuffle=False, seed=None):
+        indexes = np.arange(len(self))
+        if shuffle:
+            indexes = np.random.default_rng(seed).permutation(indexes)
+        return indexes
+
+    def split(self, test_size=0.2, by=SPLIT_RECORD, block_size=1000,
+              seed=None):
+        """
+        Splits the global indexes into (train, validation) arrays. by='tub'
+        keeps every tub on one side and by='block' keeps runs of block_size
+        consecutive records on one side, see Tub.split().
+        """
+        indexes = self.indexes()
+        if by == SPLIT_RECORD:
+            groups = None
+        elif by == SPLIT_TUB:
+            groups = np.repeat(np.arange(len(self.paths)), self.lengths)
+        elif by == SPLIT_BLOCK:
+            groups = block_groups(len(indexes), block_size)
+        else:
+            raise ValueError(f'Unknown split {by}')
+        return split_indexes(indexes, test_size, groups, seed)
+
+    def batches(self, batch_size=64, shuffle=True, seed=None,
+                drop_last=False, indexes=None):
+        """ Yields lists of records of batch_size records, from all records
+            or from the given global indexes. """
+        if indexes is None:
+            indexes = self.indexes()
+        if shuffle:
+            indexes = np.random.default_rng(seed).permutation(indexes)
+        for start in range(0, len(indexes), batch_size):
+            batch = indexes[start:start + batch_size]
+            if len(batch) < batch_size and drop_last:
+                break
+            yield self.get_records(batch)
+
+    def close(self):
+        for tub in self.tubs.values():
+            tub.close()
+        self.tubs.clear()
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        return self.get_records([index])[0]
+
+    def __iter__(self):
+        for records in self.batches(shuffle=False):
+            yield from records
+
+    def __len__(self):
+        return int(self.offsets[-1])
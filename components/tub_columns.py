@@ -0,0 +1,168 @@
+import json
+import os
+
+import numpy as np
+
+from components.datastore_v2 import BinaryRecordCodec
+
+
+COLUMNS_DIR = os.path.join('cache', 'columns')
+COLUMNS_STATE = 'columns.json'
+# Numpy types of the columns, with the value of records without the key
+COLUMN_TYPES = {
+    'float': (np.float64, np.nan),
+    'int': (np.int64, 0),
+    'boolean': (np.bool_, False),
+    'str': (np.str_, ''),
+}
+
+
+class TubColumns(object):
+    """
+    Column projections of the records of a tub, as numpy arrays indexed by
+    record index, deleted records included. \n
+    Records are decoded once, a catalog file at a time, into every column
+    which can be projected, and every column is saved as a .npy file in
+    cache/columns. Later reads only decode the records added since, and the
+    projections are dropped when the tub is compacted. Inputs of type
+    float, int, boolean and str can be projected, missing values are NaN,
+    0, False and ''.
+    """
+
+    def __init__(self, tub):
+        self.tub = tub
+        self.path = os.path.join(tub.manifest.base_path.as_posix(),
+                                 COLUMNS_DIR)
+        self.state_path = os.path.join(self.path, COLUMNS_STATE)
+        self.columns = dict()
+        self.state = self._read_state()
+
+    def _generation(self):
+        metadata = self.tub.manifest.manifest_metadata
+        return [metadata.get('created_at'), metadata.get('compacted_at')]
+
+    def _read_state(self):
+        state = None
+        if os.path.exists(self.state_path):
+            with open(self.state_path, 'r') as file:
+                state = json.load(file)
+        if state is None or state.get('generation') != self._generation():
+            state = {'generation': self._generation(), 'files': dict()}
+        return state
+
+    def _write_state(self):
+        if self.tub.manifest.read_only:
+            return
+        temporary_path = self.state_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write(json.dumps(self.state))
+        os.replace(temporary_path, self.state_path)
+
+    def column_type(self, key):
+        input_type = self._input_types().get(key)
+        if input_type not in COLUMN_TYPES:
+            raise KeyError(f'Can not project {key} of type {input_type}')
+        return input_type
+
+    def _input_types(self):
+        manifest = self.tub.manifest
+        input_types = dict(zip(manifest.inputs, manifest.types))
+        input_types.update(BinaryRecordCodec.PRIVATE_FIELDS)
+        return input_types
+
+    def column(self, key):
+        return self.load([key])[key]
+
+    def load(self, keys):
+        """
+        Returns the columns of the given keys. Records which are not
+        projected yet are decoded once, for every column which can be
+        projected, since decoding the records is what costs.
+        """
+        for key in keys:
+            self.column_type(key)
+        end = self.tub.manifest.current_index
+        projected = [key for key, input_type in self._input_types().items()
+                     if input_type in COLUMN_TYPES]
+        starts = {key: len(self._cached(key)) for key in projected}
+        missing = [key for key in projected if starts[key] < end]
+        if missing:
+            start = min(starts[key] for key in missing)
+            values = self._decode(missing, start, end)
+            for key in missing:
+                self.columns[key] = np.concatenate(
+                    [self.columns[key][:starts[key]],
+                     values[key][starts[key] - start:]])
+                self._save(key)
+            self._write_state()
+        return {key: self.columns[key][:end] for key in keys}
+
+    def _cached(self, key):
+        if key not in self.columns:
+            dtype, _ = COLUMN_TYPES[self.column_type(key)]
+            column = np.empty(0, dtype=dtype)
+            name = self.state['files'].get(key)
+            if name is not None and os.path.exists(os.path.join(self.path,
+                                                                name)):
+                column = np.load(os.path.join(self.path, name))
+            self.columns[key] = column
+        return self.columns[key]
+
+    def _save(self, key):
+        if self.tub.manifest.read_only:
+            return
+        os.makedirs(self.path, exist_ok=True)
+        name = self.state['files'].get(key)
+        if name is None:
+            name = f'column_{len(self.state["files"])}.npy'
+            self.state['files'][key] = name
+        np.save(os.path.join(self.path, name), self.columns[key])
+
+    def _decode(self, keys, start, end):
+        manifest = self.tub.manifest
+        if not manifest.read_only and manifest.current_catalog:
+            manifest.current_catalog.flush()
+        values = {key: list() for key in keys}
+        index = start
+        while index < end:
+            catalog_number = index // manifest.max_len
+            catalog_start = catalog_number * manifest.max_len
+            path = os.path.join(manifest.base_path,
+                                manifest.catalog_paths[catalog_number])
+            with open(path, 'rb') as file:
+                lines = file.read().split(b'\n')
+            count = min(end, catalog_start + manifest.max_len) - index
+            lines = lines[index - catalog_start:index - catalog_start + count]
+            if len(lines) < count:
+                raise ValueError(f'{path} is missing records')
+            # A catalog at a time, decoded records are not kept.
+            records = manifest.record_codec.decode_lines(lines)
+            for key in keys:
+                values[key].extend([record.get(key) for record in records])
+            index += count
+        columns = dict()
+        for key in keys:
+            dtype, default = COLUMN_TYPES[self.column_type(key)]
+            column = values.pop(key)
+            if dtype is not np.float64 and None in column:
+                # float columns turn None into NaN by themselves
+                column = [default if value is None else value
+                          for value in column]
+            columns[key] = np.array(column, dtype=dtype)
+        return columns
+
+    def clear(self):
+        self.columns.clear()
+
+
+class ColumnSource(object):
+    """ Mapping handed to filter predicates, loads columns on access. """
+
+    def __init__(self, columns):
+        self.columns = columns
+        self.loaded = dict()
+
+    def __getitem__(self, key):
+        if key not in self.loaded:
+            self.loaded[key] = self.columns.column(key)
+        return self.loaded[key]
@@ -0,0 +1,303 @@
+import time
+
+import numpy as np
+
+from components.image_codecs import decode_image_into
+from components.image_store import image_extension
+from components.tub_split import block_groups
+
+
+ONE_BYTE_SCALE = 1.0 / 255.0
+LABEL_DTYPES = {
+    'float': np.float32,
+    'int': np.int64,
+    'boolean': np.bool_,
+}
+
+
+class TubDataset(object):
+    """
+    Reads a Tub as training batches. \n
+    Iterating the dataset runs one epoch and yields (images, labels), where
+    images is a (B, H, W, C) uint8 or float32 array and labels maps each
+    label input to a (B,) array. float32 images are scaled to [0, 1].
+    Images are decoded straight into preallocated batch buffers, which are
+    reused by the next batch unless reuse_buffers is False. \n
+    Records are fetched by index, so shuffling costs no scans. indexes
+    defaults to all records of the tub, deleted records are skipped at the
+    start of every epoch, indexes can also be a view like the result of
+    Tub.filter(). augmentation, for example a BatchAugmentation,
+    is called on every batch before it is yielded. \n
+    With a sampler, like a BalancedSampler, every epoch draws len(indexes)
+    records from the sampler instead of shuffling indexes.
+    """
+
+    def __init__(self, tub, image_key='cam/image_array',
+                 label_keys=('user/angle', 'user/throttle'), batch_size=64,
+                 image_shape=None, dtype=np.uint8, shuffle=True,
+                 drop_last=False, seed=None, indexes=None,
+                 reuse_buffers=True, augmentation=None, sampler=None):
+        self.tub = tub
+        self.image_key = image_key
+        self.label_keys = list(label_keys)
+        self.batch_size = batch_size
+        self.dtype = np.dtype(dtype)
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.random = np.random.default_rng(seed)
+        self.reuse_buffers = reuse_buffers
+        self.augmentation = augmentation
+        self.sampler = sampler
+        if indexes is None:
+            indexes = tub.view()
+        # A view, like the result of Tub.filter(), or record indexes
+        indexes = getattr(indexes, 'indexes', indexes)
+        self.indexes = np.asarray(indexes, dtype=np.int64)
+        input_types = dict(zip(tub.manifest.inputs, tub.manifest.types))
+        self.label_dtypes = {key: LABEL_DTYPES.get(input_types.get(key),
+                                                   np.object_)
+                             for key in self.label_keys}
+        # Used for records without a label value
+        self.label_defaults = {key: None if dtype is np.object_ else 0
+                               for key, dtype in self.label_dtypes.items()}
+        # (H, W, C), taken from the first image when not given
+        self.image_shape = tuple(image_shape) if image_shape is not None \
+            else self._first_image_shape()
+        self.frames = 0
+        self.decode_seconds = 0.0
+        self.images = None
+        self.labels = None
+
+    def _first_image_shape(self):
+        for index in self.indexes[:1]:
+            record = self.tub[int(index)]
+            image = self.tub.load_image(record[self.image_key])
+            if image.ndim == 2:
+                return image.shape + (1,)
+            return image.shape
+        raise ValueError('Can not infer the image shape of an empty dataset')
+
+    def _allocate(self):
+        images = np.empty((self.batch_size,) + self.image_shape,
+                          dtype=self.dtype)
+        labels = {key: np.empty(self.batch_size, dtype=dtype)
+                  for key, dtype in self.label_dtypes.items()}
+        return images, labels
+
+    def epoch_indexes(self):
+        """ The record indexes of the next epoch, in reading order. """
+        deleted = self.tub.manifest.deleted_indexes
+        indexes = self.indexes
+        if self.sampler is not None:
+            indexes = self.sampler.sample(len(indexes))
+        if len(deleted) > 0:
+            indexes = indexes[~deleted.mask(indexes)]
+        if self.shuffle and self.sampler is None:
+            indexes = self.random.permutation(indexes)
+        return indexes
+
+    def read_batch(self, batch_indexes, images, labels):
+        """ Reads the given records into the batch buffers. """
+        start = time.perf_counter()
+        records = self.tub.get_records(batch_indexes.tolist())
+        height, width, depth = self.image_shape
+        uint8_image = None
+        for position, record in enumerate(records):
+            reference = record[self.image_key]
+            if self.tub.image_cache is not None:
+                image = self.tub.load_image(reference, size=(width, height),
+                                            depth=depth)
+                if self.dtype == np.uint8:
+                    images[position] = image
+                else:
+                    np.multiply(image, ONE_BYTE_SCALE, out=images[position],
+                                casting='unsafe')
+            elif self.dtype == np.uint8:
+                decode_image_into(self.tub.read_image(reference),
+                                  image_extension(reference), images[position])
+            else:
+                if uint8_image is None:
+                    uint8_image = np.empty(self.image_shape, dtype=np.uint8)
+                decode_image_into(self.tub.read_image(reference),
+                                  image_extension(reference), uint8_image)
+                np.multiply(uint8_image, ONE_BYTE_SCALE,
+                            out=images[position], casting='unsafe')
+            for key in self.label_keys:
+                labels[key][position] = record.get(key,
+                                                   self.label_defaults[key])
+        self.frames += len(records)
+        self.decode_seconds += time.perf_counter() - start
+
+    @property
+    def frames_per_second(self):
+        """ Read throughput so far, decoding included. """
+        if self.decode_seconds <= 0:
+            return 0.0
+        return self.frames / self.decode_seconds
+
+    def __iter__(self):
+        indexes = self.epoch_indexes()
+        for start in range(0, len(indexes), self.batch_size):
+            batch_indexes = indexes[start:start + self.batch_size]
+            count = len(batch_indexes)
+            if count < self.batch_size and self.drop_last:
+                break
+            if self.images is None or not self.reuse_buffers:
+                self.images, self.labels = self._allocate()
+            self.read_batch(batch_indexes, self.images, self.labels)
+            images = self.images[:count]
+            labels = {key: value[:count] for key, value in self.labels.items()}
+            if self.augmentation is not None:
+                images, labels = self.augmentation(images, labels)
+            yield images, labels
+
+    def __len__(self):
+        count = len(self.indexes)
+        if self.drop_last:
+            return count // self.batch_size
+        return (count + self.batch_size - 1) // self.batch_size
+
+
+class TubSequenceDataset(object):
+    """
+    Reads a Tub as batches of windows of consecutive frames, for temporal
+    models. \n
+    Iterating yields (images, labels), where images is a (B, K, H, W, C)
+    array of windows of K = sequence_length frames and labels maps each
+    label input to a (B, K) array. Frames of a window are dilation records
+    apart and windows start every stride records. A window never crosses a
+    _session_id boundary nor contains a deleted record. \n
+    Frames are decoded once per batch, whatever the number of windows they
+    belong to, and frames of the previous batch are reused, so reading the
+    windows in order decodes every frame about once. shuffle draws blocks
+    of shuffle_block consecutive windows, batch_size by default, in a
+    random order, which keeps overlapping windows in the same batch. A
+    shuffle_block of 1 shuffles single windows, which decodes up to K
+    times more frames. The yielded buffers are reused by the next batch.
+    """
+
+    def __init__(self, tub, sequence_length=3, stride=1, dilation=1,
+                 image_key='cam/image_array',
+                 label_keys=('user/angle', 'user/throttle'), batch_size=64,
+                 image_shape=None, dtype=np.uint8, shuffle=True,
+                 drop_last=False, seed=None, shuffle_block=None):
+        self.tub = tub
+        self.sequence_length = sequence_length
+        self.stride = stride
+        self.dilation = dilation
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.shuffle_block = shuffle_block if shuffle_block is not None \
+            else batch_size
+        self.drop_last = drop_last
+        self.random = np.random.default_rng(seed)
+        # Decodes the frames of a batch into a pool of frames
+        self.reader = TubDataset(tub, image_key=image_key,
+                                 label_keys=label_keys, batch_size=batch_size,
+                                 image_shape=image_shape, dtype=dtype,
+                                 shuffle=False)
+        self.image_shape = self.reader.image_shape
+        self.windows = self._windows()
+        pool_size = batch_size * sequence_length
+        self.pools = [self._allocate_pool(pool_size) for _ in range(2)]
+        self.scratch = self._allocate_pool(batch_size)
+        # Record indexes held by the frame pool of the previous batch
+        self.pool_indexes = np.empty(0, dtype=np.int64)
+        self.images = np.empty((batch_size, sequence_length) +
+                               self.image_shape, dtype=self.reader.dtype)
+        self.labels = {key: np.empty((batch_size, sequence_length),
+                                     dtype=dtype)
+                       for key, dtype in self.reader.label_dtypes.items()}
+        self.decoded_frames = 0
+
+    def _allocate_pool(self, size):
+        images = np.empty((size,) + self.image_shape, dtype=self.reader.dtype)
+        labels = {key: np.empty(size, dtype=dtype)
+                  for key, dtype in self.reader.label_dtypes.items()}
+        return images, labels
+
+    def session_codes(self):
+        """ A session number per record index, -1 for deleted records. """
+        with self.tub.lock:
+            self.tub.index.catch_up(self.tub.manifest)
+            codes = self.tub.index.session_codes()
+        deleted = self.tub.manifest.deleted_indexes
+        if len(deleted) > 0:
+            codes[deleted.mask(np.arange(len(codes)))] = -1
+        return codes
+
+    def _windows(self):
+        """ (windows, K) array of the record indexes of every window. """
+        codes = self.session_codes()
+        span = (self.sequence_length - 1) * self.dilation
+        count = len(codes) - span
+        if count <= 0:
+            return np.empty((0, self.sequence_length), dtype=np.int64)
+        starts = np.arange(count)
+        valid = codes[:count] >= 0
+        for frame in range(1, self.sequence_length):
+            valid &= codes[frame * self.dilation:][:count] == codes[:count]
+        # Windows start every stride records from the start of each run of
+        # records of one session.
+        run_starts = np.flatnonzero(np.diff(codes, prepend=-2) != 0)
+        run_start = run_starts[np.searchsorted(run_starts, starts,
+                                               side='right') - 1]
+        valid &= (starts - run_start) % self.stride == 0
+        starts = starts[valid]
+        offsets = np.arange(self.sequence_length) * self.dilation
+        return starts[:, None] + offsets
+
+    def _read_frames(self, indexes):
+        """ Fills the next frame pool with the given sorted record indexes,
+            decoding only the frames which are not in the previous pool. """
+        previous_images, previous_labels = self.pools[0]
+        images, labels = self.pools[1]
+        reused = np.isin(indexes, self.pool_indexes)
+        if reused.any():
+            source = np.searchsorted(self.pool_indexes, indexes[reused])
+            target = np.flatnonzero(reused)
+            images[target] = previous_images[source]
+            for key, values in labels.items():
+                values[target] = previous_labels[key][source]
+        decoded = np.flatnonzero(~reused)
+        if len(decoded) > 0:
+            scratch_images, scratch_labels = self.scratch
+            for start in range(0, len(decoded), self.batch_size):
+                positions = decoded[start:start + self.batch_size]
+                count = len(positions)
+                self.reader.read_batch(indexes[positions], scratch_images,
+                                       scratch_labels)
+                images[positions] = scratch_images[:count]
+                for key, values in labels.items():
+                    values[positions] = scratch_labels[key][:count]
+            self.decoded_frames += len(decoded)
+        self.pools.reverse()
+        self.pool_indexes = indexes
+        return self.pools[0]
+
+    def __iter__(self):
+        windows = self.windows
+        if self.shuffle and len(windows) > 0:
+            blocks = block_groups(len(windows), self.shuffle_block)
+            order = self.random.permutation(blocks[-1] + 1)
+            windows = windows[np.argsort(order[blocks], kind='stable')]
+        for start in range(0, len(windows), self.batch_size):
+            batch_windows = windows[start:start + self.batch_size]
+            count = len(batch_windows)
+            if count < self.batch_size and self.drop_last:
+                break
+            frame_indexes, positions = np.unique(batch_windows,
+                                                 return_inverse=True)
+            positions = positions.reshape(batch_windows.shape)
+            frame_images, frame_labels = self._read_frames(frame_indexes)
+            np.take(frame_images, positions, axis=0, out=self.images[:count])
+            for key, values in frame_labels.items():
+                np.take(values, positions, out=self.labels[key][:count])
+            yield self.images[:count], \
+                {key: value[:count] for key, value in self.labels.items()}
+
+    def __len__(self):
+        count = len(self.windows)
+        if self.drop_last:
+            return count // self.batch_size
+        return (count + self.batch_size - 1) // self.batch_size
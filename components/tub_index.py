@@ -0,0 +1,170 @@
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+
+from components.datastore_v2 import IndexRanges, LineIndex
+
+
+TIMESTAMPS_INDEX = 'timestamps.index'
+SESSIONS_INDEX = 'sessions.index'
+
+
+class TubIndex(object):
+    """
+    A sidecar index of the records of a tub, kept next to its catalogs. \n
+    timestamps.index holds the _timestamp_ms of every record, in record
+    order, as a LineIndex of uint64 values. sessions.index is a json object
+    which maps every _session_id to its IndexRanges, with the number of
+    records it covers. \n
+    The index is appended to as records are written and flushed by
+    flush(). Records missing from the index, written before a crash or by
+    a version without the index, are read back by catch_up(), so the index
+    of an existing tub is built on its first open. Deleted records stay in
+    the index, views over it leave them out.
+    """
+
+    FILES = (TIMESTAMPS_INDEX, SESSIONS_INDEX)
+
+    def __init__(self, base_path, read_only=False):
+        self.base_path = base_path
+        self.read_only = read_only
+        self.sessions_path = os.path.join(base_path, SESSIONS_INDEX)
+        self.timestamps = LineIndex(os.path.join(base_path, TIMESTAMPS_INDEX),
+                                    read_only=read_only, auto_flush=False)
+        self.sessions = OrderedDict()
+        self.records = 0
+        if os.path.exists(self.sessions_path):
+            with open(self.sessions_path, 'r') as file:
+                contents = json.load(file)
+            self.records = contents['records']
+            for session_id, ranges in contents['sessions']:
+                self.sessions[session_id] = IndexRanges(ranges)
+        self._dirty = False
+        # Numpy copy of the timestamps, with the sort order when they are
+        # not monotonic. Rebuilt when records were added.
+        self._sorted_timestamps = None
+        self._order = None
+
+    def append(self, index, session_id, timestamp_ms):
+        if index != self.records:
+            raise ValueError(f'Expected record {self.records}, got {index}')
+        self.timestamps.append(max(int(timestamp_ms or 0), 0))
+        ranges = self.sessions.get(session_id)
+        if ranges is None:
+            ranges = self.sessions[session_id] = IndexRanges()
+        ranges.add(index)
+        self.records += 1
+        self._dirty = True
+        self._sorted_timestamps = None
+
+    def catch_up(self, manifest):
+        """ Indexes the records of the manifest which are missing from the
+            index. Returns the number of records read. """
+        length = min(len(self.timestamps), self.records)
+        if length > manifest.current_index:
+            # Indexed records which were never committed to the manifest
+            length = manifest.current_index
+        if length != self.records or length != len(self.timestamps):
+            self.truncate(length)
+        for index in range(length, manifest.current_index):
+            try:
+                record = manifest.read_record(index, include_deleted=True)
+            except Exception:
+                # Damaged records are indexed without a session and time,
+                # see TubVerifier.
+                print(f'Indexing unreadable record {index}')
+                record = dict()
+            self.append(index, record.get('_session_id'),
+                        record.get('_timestamp_ms'))
+        return manifest.current_index - length
+
+    def rebuild(self, manifest):
+        """ Indexes all the records of the manifest again. """
+        self.truncate(0)
+        self.catch_up(manifest)
+        self.flush()
+
+    def truncate(self, length):
+        self.timestamps.truncate(length)
+        for session_id in list(self.sessions):
+            ranges = self.sessions[session_id]
+            ranges.discard_range(length, max(self.records, length + 1))
+            if len(ranges) == 0:
+                del self.sessions[session_id]
+        self.records = length
+        self._dirty = True
+        self._sorted_timestamps = None
+
+    def flush(self, fsync=False):
+        if self.read_only:
+            return
+        self.timestamps.flush(fsync)
+        if not self._dirty:
+            return
+        contents = {
+            'records': self.records,
+            'sessions': [[session_id, ranges.ranges()]
+                         for session_id, ranges in self.sessions.items()],
+        }
+        temporary_path = self.sessions_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write(json.dumps(contents))
+            if fsync:
+                file.flush()
+                os.fsync(file.fileno())
+        os.replace(temporary_path, self.sessions_path)
+        self._dirty = False
+
+    def session_ids(self):
+        return list(self.sessions)
+
+    def session_indexes(self, session_id):
+        """ The IndexRanges of the records of a session. """
+        ranges = self.sessions.get(session_id)
+        if ranges is None:
+            raise KeyError(f'Unknown session {session_id}')
+        return ranges
+
+    def session_codes(self):
+        """ The number of the session of every record, in record order. """
+        codes = np.empty(self.records, dtype=np.int64)
+        for code, ranges in enumerate(self.sessions.values()):
+            for start, end in ranges.ranges():
+                codes[start:end] = code
+        return codes
+
+    def time_range(self, start_ms, end_ms):
+        """
+        The indexes of the records with start_ms <= _timestamp_ms < end_ms, a
+        range when timestamps are monotonic, which is the usual case.
+        """
+        if self._sorted_timestamps is None:
+            timestamps = self.timestamps.to_array().astype(np.int64)
+            self._order = None
+            if np.any(timestamps[1:] < timestamps[:-1]):
+                # The clock went back, search a sorted copy.
+                self._order = np.argsort(timestamps, kind='stable')
+                timestamps = timestamps[self._order]
+            self._sorted_timestamps = timestamps
+        low, high = np.searchsorted(self._sorted_timestamps,
+                                    [start_ms, end_ms], side='left')
+        if self._order is None:
+            return range(int(low), int(high))
+        return np.sort(self._order[low:high])
+
+    def close(self):
+        self.flush()
+        self.timestamps.close()
+
+    def __len__(self):
+        return self.records
+
+    @classmethod
+    def remove(cls, base_path):
+        """ Removes the index files, the index is rebuilt on the next open. """
+        for name in cls.FILES:
+            path = os.path.join(base_path, name)
+            if os.path.exists(path):
+                os.remove(path)
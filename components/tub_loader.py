@@ -0,0 +1,215 @@
+import multiprocessing
+import queue
+import time
+import traceback
+
+import numpy as np
+
+from components.tub_dataset import TubDataset
+
+
+# Seconds between checks that the workers are still alive
+POLL_INTERVAL = 1.0
+
+
+def _load_batches(base_path, settings, images_buffer, label_buffers, tasks,
+                  results):
+    """ Worker loop, decodes batches into the slots named by tasks. """
+    from components.tub_v2 import Tub
+    tub = None
+    try:
+        tub = Tub(base_path, read_only=True)
+        dataset = TubDataset(tub, shuffle=False, indexes=(), **settings)
+        slots = len(images_buffer) // (dataset.batch_size *
+                                        int(np.prod(dataset.image_shape)) *
+                                        dataset.dtype.itemsize)
+        images = np.frombuffer(images_buffer, dtype=dataset.dtype).reshape(
+            (slots, dataset.batch_size) + dataset.image_shape)
+        labels = {key: np.frombuffer(label_buffers[key], dtype=dtype)
+                  .reshape(slots, dataset.batch_size)
+                  for key, dtype in dataset.label_dtypes.items()}
+        while True:
+            task = tasks.get()
+            if task is None:
+                break
+            slot, batch_number, batch_indexes = task
+            slot_labels = {key: value[slot] for key, value in labels.items()}
+            try:
+                dataset.read_batch(batch_indexes, images[slot], slot_labels)
+            except IndexError:
+                # Records added after the worker started
+                tub.manifest.reload()
+                dataset.read_batch(batch_indexes, images[slot], slot_labels)
+            results.put((slot, batch_number, None))
+    except Exception:
+        results.put((None, None, traceback.format_exc()))
+    finally:
+        if tub is not None:
+            tub.close()
+
+
+class TubLoader(object):
+    """
+    Reads a Tub as training batches, like TubDataset, with the decoding
+    spread over a pool of worker processes. \n
+    Batches are decoded into a ring of workers * prefetch shared memory
+    slots, workers only send back slot numbers so images are never pickled.
+    Batches are yielded in the order of epoch_indexes() whatever the order
+    in which workers finish, so a seed gives the same batches every run.
+    Yielded arrays live in the ring and are reused once the next batch is
+    requested, copy them to keep them. augmentation is applied in the
+    training process, on the batches in the ring. \n
+    Workers start on the first iteration and are shared by all epochs. Call
+    close(), or use the loader as a context manager, to stop them.
+    """
+
+    def __init__(self, tub, image_key='cam/image_array',
+                 label_keys=('user/angle', 'user/throttle'), batch_size=64,
+                 image_shape=None, dtype=np.uint8, shuffle=True,
+                 drop_last=False, seed=None, indexes=None, workers=4,
+                 prefetch=2, start_method=None, augmentation=None,
+                 sampler=None):
+        self.dataset = TubDataset(tub, image_key=image_key,
+                                  label_keys=label_keys, batch_size=batch_size,
+                                  image_shape=image_shape, dtype=dtype,
+                                  shuffle=shuffle, drop_last=drop_last,
+                                  seed=seed, indexes=indexes,
+                                  augmentation=augmentation, sampler=sampler)
+        if any(dtype is np.object_
+               for dtype in self.dataset.label_dtypes.values()):
+            raise ValueError('Only float, int and boolean labels can be '
+                             'loaded')
+        self.base_path = tub.manifest.base_path.as_posix()
+        self.settings = {
+            'image_key': image_key,
+            'label_keys': list(label_keys),
+            'batch_size': batch_size,
+            'image_shape': self.dataset.image_shape,
+            'dtype': self.dataset.dtype.name,
+        }
+        self.workers = workers
+        self.slots = workers * prefetch
+        self.context = multiprocessing.get_context(start_method)
+        self.processes = list()
+        self.tasks = None
+        self.results = None
+        self.images = None
+        self.labels = None
+        # Batches submitted to the workers and not yielded yet
+        self.pending = 0
+        self.frames = 0
+        self.seconds = 0.0
+
+    def _start(self):
+        dataset = self.dataset
+        frame_size = int(np.prod(dataset.image_shape)) * dataset.dtype.itemsize
+        images_buffer = self.context.RawArray(
+            'B', self.slots * dataset.batch_size * frame_size)
+        label_buffers = {key: self.context.RawArray(
+            'B', self.slots * dataset.batch_size * np.dtype(dtype).itemsize)
+            for key, dtype in dataset.label_dtypes.items()}
+        self.images = np.frombuffer(images_buffer, dtype=dataset.dtype) \
+            .reshape((self.slots, dataset.batch_size) + dataset.image_shape)
+        self.labels = {key: np.frombuffer(label_buffers[key], dtype=dtype)
+                       .reshape(self.slots, dataset.batch_size)
+                       for key, dtype in dataset.label_dtypes.items()}
+        self.tasks = self.context.Queue()
+        self.results = self.context.Queue()
+        for _ in range(self.workers):
+            process = self.context.Process(
+                target=_load_batches,
+                args=(self.base_path, self.settings, images_buffer,
+                      label_buffers, self.tasks, self.results),
+                daemon=True)
+            process.start()
+            self.processes.append(process)
+
+    def _result(self):
+        while True:
+            try:
+                slot, batch_number, error = self.results.get(
+                    timeout=POLL_INTERVAL)
+            except queue.Empty:
+                if not all(process.is_alive() for process in self.processes):
+                    self.close()
+                    raise RuntimeError('A tub loader worker died')
+                continue
+            if error is not None:
+                self.close()
+                raise RuntimeError(f'A tub loader worker failed\n{error}')
+            self.pending -= 1
+            return slot, batch_number
+
+    def _drain(self):
+        # Batches left over by an epoch which was not run to the end
+        while self.pending > 0:
+            self._result()
+
+    def __iter__(self):
+        if not self.processes:
+            self._start()
+        self._drain()
+        dataset = self.dataset
+        indexes = dataset.epoch_indexes()
+        batch_size = dataset.batch_size
+        batches = [indexes[start:start + batch_size]
+                   for start in range(0, len(indexes), batch_size)]
+        if batches and dataset.drop_last and len(batches[-1]) < batch_size:
+            batches.pop()
+        free_slots = list(range(self.slots))
+        ready = dict()
+        submitted = 0
+        start = time.perf_counter()
+        for batch_number in range(len(batches)):
+            while free_slots and submitted < len(batches):
+                self.tasks.put((free_slots.pop(), submitted,
+                                batches[submitted]))
+                self.pending += 1
+                submitted += 1
+            while batch_number not in ready:
+                slot, number = self._result()
+                ready[number] = slot
+            slot = ready.pop(batch_number)
+            count = len(batches[batch_number])
+            images = self.images[slot, :count]
+            labels = {key: value[slot, :count]
+                      for key, value in self.labels.items()}
+            if dataset.augmentation is not None:
+                images, labels = dataset.augmentation(images, labels)
+            self.frames += count
+            self.seconds += time.perf_counter() - start
+            yield images, labels
+            start = time.perf_counter()
+            free_slots.append(slot)
+
+    @property
+    def frames_per_second(self):
+        """ Throughput so far, time spent by the consumer excluded. """
+        if self.seconds <= 0:
+            return 0.0
+        return self.frames / self.seconds
+
+    def close(self):
+        """ Stops the workers, waiting for them to finish their batch. """
+        if not self.processes:
+            return
+        for _ in self.processes:
+            self.tasks.put(None)
+        for process in self.processes:
+            process.join(timeout=5)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+        self.processes = list()
+        self.tasks.close()
+        self.results.close()
+        self.pending = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self.dataset)
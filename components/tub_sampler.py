@@ -0,0 +1,107 @@
+import numpy as np
+
+from car.utils import linear_bin_index
+
+
+class AliasTable(object):
+    """
+    Walker's alias method: draws from a discrete distribution over
+    len(weights) outcomes in O(1) per draw, with one uniform integer and one
+    uniform float. The table is built with Vose's algorithm in O(n).
+    """
+
+    def __init__(self, weights):
+        weights = np.asarray(weights, dtype=np.float64)
+        if len(weights) == 0 or weights.sum() <= 0:
+            raise ValueError('The alias table needs a positive weight')
+        count = len(weights)
+        scaled = weights * count / weights.sum()
+        self.probabilities = np.ones(count)
+        self.aliases = np.arange(count)
+        small = [index for index in range(count) if scaled[index] < 1.0]
+        large = [index for index in range(count) if scaled[index] >= 1.0]
+        while small and large:
+            less = small.pop()
+            more = large.pop()
+            self.probabilities[less] = scaled[less]
+            self.aliases[less] = more
+            scaled[more] -= 1.0 - scaled[less]
+            if scaled[more] < 1.0:
+                small.append(more)
+            else:
+                large.append(more)
+        # What is left has a probability of 1, up to rounding errors.
+
+    def sample(self, random, count):
+        outcomes = random.integers(len(self.probabilities), size=count)
+        keep = random.random(count) < self.probabilities[outcomes]
+        return np.where(keep, outcomes, self.aliases[outcomes])
+
+
+class BalancedSampler(object):
+    """
+    Draws record indexes with weights which balance the histogram of a
+    float input, usually user/angle. \n
+    Values are binned like utils.linear_bin (bins, offset and value_range
+    are its N, offset and R). Every record is weighted by the inverse of
+    the count of its bin raised to balance, so balance=1 gives every bin
+    the same share of the draws and balance=0 draws uniformly. \n
+    Since records of one bin share their weight, draws pick a bin from an
+    alias table over the bins and then a record of that bin uniformly,
+    which is the same distribution as an alias table over all records. The
+    construction is a vectorized sort, the same seed gives the same draws.
+    """
+
+    def __init__(self, values, indexes=None, bins=15, offset=1,
+                 value_range=2.0, balance=1.0, seed=None):
+        values = np.asarray(values, dtype=np.float64)
+        if indexes is None:
+            indexes = np.arange(len(values))
+        indexes = np.asarray(indexes, dtype=np.int64)
+        # Records without a value are never drawn.
+        known = ~np.isnan(values)
+        values, indexes = values[known], indexes[known]
+        if len(values) == 0:
+            raise ValueError('No values to sample from')
+        self.bins = bins
+        self.balance = balance
+        self.random = np.random.default_rng(seed)
+        bin_indexes = linear_bin_index(values, N=bins, offset=offset,
+                                       R=value_range)
+        order = np.argsort(bin_indexes, kind='stable')
+        # Record indexes grouped by bin
+        self.indexes = indexes[order]
+        self.counts = np.bincount(bin_indexes, minlength=bins)
+        self.starts = np.concatenate(([0], np.cumsum(self.counts)[:-1]))
+        # The weights of the records of a bin sum to count ** (1 - balance)
+        bin_weights = np.zeros(bins)
+        filled = self.counts > 0
+        bin_weights[filled] = self.counts[filled] ** (1.0 - balance)
+        self.bin_table = AliasTable(bin_weights)
+        self.bin_shares = bin_weights / bin_weights.sum()
+
+    @classmethod
+    def from_tub(cls, tub, key='user/angle', **kwargs):
+        """ Reads the key column of the records of the tub, deleted records
+            excluded. """
+        values = tub.column(key).astype(np.float64)
+        indexes = np.arange(len(values))
+        deleted = tub.manifest.deleted_indexes
+        if len(deleted) > 0:
+            kept = ~deleted.mask(indexes)
+            values, indexes = values[kept], indexes[kept]
+        return cls(values, indexes, **kwargs)
+
+    def sample(self, count):
+        """ Draws count record indexes, with replacement. """
+        bins = self.bin_table.sample(self.random, count)
+        offsets = (self.random.random(count) * self.counts[bins]) \
+            .astype(np.int64)
+        return self.indexes[self.starts[bins] + offsets]
+
+    def histogram(self):
+        """ Records per bin, and the expected share of draws per bin. """
+        return self.counts.copy(), self.bin_shares.copy()
+
+    def __len__(self):
+        return len(self.indexes)
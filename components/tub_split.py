@@ -0,0 +1,48 @@
+import numpy as np
+
+
+SPLIT_RECORD = 'record'
+SPLIT_SESSION = 'session'
+SPLIT_BLOCK = 'block'
+
+
+def split_indexes(indexes, test_size=0.2, groups=None, seed=None):
+    """
+    Splits record indexes into (train, validation) numpy arrays, both in
+    the order of indexes. \n
+    Without groups, a random test_size share of the records goes to
+    validation. With groups, an array of one group per index like session
+    codes or block numbers, whole groups go to either side, so validation
+    records have no neighbours in training. Groups are drawn in a random
+    order and as many are taken as get the validation set closest to
+    test_size. The same seed gives the same split.
+    """
+    indexes = np.asarray(getattr(indexes, 'indexes', indexes), dtype=np.int64)
+    if not 0.0 <= test_size <= 1.0:
+        raise ValueError(f'test_size must be in [0, 1], got {test_size}')
+    random = np.random.default_rng(seed)
+    if groups is None:
+        count = int(round(len(indexes) * test_size))
+        validation = np.zeros(len(indexes), dtype=bool)
+        validation[random.permutation(len(indexes))[:count]] = True
+    else:
+        groups = np.asarray(groups)
+        if len(groups) != len(indexes):
+            raise ValueError(f'Expected {len(indexes)} groups, '
+                             f'got {len(groups)}')
+        _, inverse, counts = np.unique(groups, return_inverse=True,
+                                       return_counts=True)
+        order = random.permutation(len(counts))
+        taken = np.concatenate(([0], np.cumsum(counts[order])))
+        count = int(np.argmin(np.abs(taken - len(indexes) * test_size)))
+        validation_groups = np.zeros(len(counts), dtype=bool)
+        validation_groups[order[:count]] = True
+        validation = validation_groups[inverse]
+    return indexes[~validation], indexes[validation]
+
+
+def block_groups(count, block_size):
+    """ Groups of block_size consecutive positions. """
+    if block_size < 1:
+        raise ValueError(f'block_size must be positive, got {block_size}')
+    return np.arange(count, dtype=np.int64) // block_size
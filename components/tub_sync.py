@@ -0,0 +1,363 @@
+#!/usr/bin/env python3
+"""
+Ships the records added to a tub since the last sync, to a directory or as
+a tar or zip stream.
+
+Usage: python -m components.tub_sync --tub ~/mycar/data [--name host]
+       (--to /mnt/host/data | --tar data.tar | --zip data.zip)
+       Use - as the tar or zip file to stream to stdout, for example
+       python -m components.tub_sync --tub data --tar - | ssh host tar x
+"""
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tarfile
+import time
+import zipfile
+
+import numpy as np
+
+from components.datastore_v2 import LineIndex, NEWLINE, line_end_offsets, \
+    read_manifest_file, record_codec_from_description
+from components.image_store import parse_blob_reference
+
+
+SYNC_DIR = 'sync'
+MANIFEST = 'manifest.json'
+IMAGE_TYPES = ('image_array', 'image')
+# Bytes copied at a time, which bounds the memory of a sync
+CHUNK_SIZE = 1 << 20
+FORMAT_TAR = 'tar'
+FORMAT_ZIP = 'zip'
+
+
+class TubSync(object):
+    """
+    Incremental export of a tub, which can run while the tub is recorded
+    into. \n
+    The sync state, kept in sync/<name>.json inside the tub, holds the number
+    of records shipped and the shipped size of every image blob. A sync reads
+    manifest.json once and ships the records committed since the last sync:
+    the new part of the catalogs, their catalog manifests and line indexes,
+    the images referenced by the new records, then manifest.json, which also
+    carries deletions. \n
+    to_directory() appends the new bytes to the files of a copy of the tub,
+    so a sync costs the new data only. Tar and zip entries hold whole files:
+    catalogs which are still growing, and blobs of the blob image storage,
+    are shipped again whole, extracting the archives in order rebuilds the
+    tub. Files are copied a chunk at a time, archives can be streamed to
+    pipes. \n
+    A compacted tub is shipped in full again, an archive of a full sync
+    should be extracted into an empty directory. The state is only saved
+    once a sync completed.
+    """
+
+    def __init__(self, base_path, name='default', chunk_size=CHUNK_SIZE):
+        self.base_path = os.path.expanduser(base_path)
+        self.name = name
+        self.chunk_size = chunk_size
+        self.state_path = os.path.join(self.base_path, SYNC_DIR,
+                                       f'{name}.json')
+
+    def to_directory(self, target):
+        """ Syncs into a copy of the tub at target. A full sync replaces
+            the copy, target is only removed when its manifest.json belongs
+            to a copy of this tub, a ValueError is raised otherwise. """
+        target = os.path.expanduser(target)
+        if os.path.realpath(target) == os.path.realpath(self.base_path):
+            raise ValueError(f'Can not sync {self.base_path} into itself')
+        plan = self._plan(whole_files=False)
+        if not plan['full'] and not self._target_matches(plan, target):
+            # The copy is not the one the state describes, start over.
+            plan = self._plan(whole_files=False, full=True)
+        if plan['full'] and os.path.exists(os.path.join(target, MANIFEST)):
+            self._check_copy(target, plan['state']['generation'])
+            shutil.rmtree(target)
+        for entry in plan['entries']:
+            self._write_file(entry, target)
+        self._write_state(plan['state'])
+        return self._summary(plan)
+
+    def to_archive(self, output, archive_format=FORMAT_TAR):
+        """ Writes the sync as a tar or zip archive into output, a path or a
+            writable binary file object, which does not need to be
+            seekable. Entries are under the name of the tub folder. """
+        if archive_format not in (FORMAT_TAR, FORMAT_ZIP):
+            raise ValueError(f'Unknown archive format {archive_format}')
+        plan = self._plan(whole_files=True)
+        prefix = os.path.basename(os.path.normpath(self.base_path))
+        if archive_format == FORMAT_TAR:
+            if isinstance(output, str):
+                archive = tarfile.open(output, mode='w')
+            else:
+                archive = tarfile.open(fileobj=output, mode='w|')
+            with archive:
+                for entry in plan['entries']:
+                    self._write_tar_entry(archive, entry, prefix)
+        else:
+            with zipfile.ZipFile(output, mode='w') as archive:
+                for entry in plan['entries']:
+                    self._write_zip_entry(archive, entry, prefix)
+        self._write_state(plan['state'])
+        return self._summary(plan)
+
+    def reset(self):
+        """ Forgets what was shipped, the next sync ships the whole tub. """
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+    def _read_state(self):
+        if not os.path.exists(self.state_path):
+            return None
+        with open(self.state_path, 'r') as file:
+            return json.load(file)
+
+    def _write_state(self, state):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        temporary_path = self.state_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            file.write(json.dumps(state))
+        os.replace(temporary_path, self.state_path)
+
+    def _read_manifest(self):
+        # The writer rewrites the last line of manifest.json, read it again
+        # when it was caught in between.
+        path = os.path.join(self.base_path, MANIFEST)
+        for attempt in range(20):
+            try:
+                contents, lines = read_manifest_file(path)
+                inputs, types, _, manifest_metadata, catalog_metadata = lines
+                return contents, inputs, types, manifest_metadata, \
+                    catalog_metadata
+            except ValueError:
+                time.sleep(0.01)
+        raise ValueError(f'Can not read {path}')
+
+    def _plan(self, whole_files, full=False):
+        """
+        Lists the entries of a sync, dicts with the relative name of a file
+        and either the path of its source and the [start, end) bytes to copy
+        or its data. Entries are written at offset start of their file.
+        """
+        contents, inputs, types, manifest_metadata, catalog_metadata = \
+            self._read_manifest()
+        generation = [manifest_metadata.get('created_at'),
+                      manifest_metadata.get('compacted_at')]
+        state = self._read_state()
+        current_index = catalog_metadata['current_index']
+        if state is None or state['generation'] != generation \
+                or state['records'] > current_index:
+            full = True
+        shipped = 0 if full else state['records']
+        blobs = dict() if full else dict(state['blobs'])
+        max_len = catalog_metadata['max_len']
+        record_codec = record_codec_from_description(
+            manifest_metadata.get('record_codec'))
+        image_keys = [key for key, input_type in zip(inputs, types)
+                      if input_type in IMAGE_TYPES]
+        entries = list()
+        blob_ends = dict()
+        for catalog_number in range(shipped // max_len,
+                                    len(catalog_metadata['paths'])):
+            name = catalog_metadata['paths'][catalog_number]
+            catalog_start = catalog_number * max_len
+            count = min(current_index, catalog_start + max_len) \
+                - catalog_start
+            first_line = max(shipped - catalog_start, 0)
+            if count <= first_line:
+                # No new records
+                continue
+            catalog_entries, new_lines = self._catalog_entries(
+                name, first_line, count, whole_files)
+            entries.extend(catalog_entries)
+            references = self._image_references(record_codec, new_lines,
+                                                image_keys)
+            for reference in references:
+                parsed = parse_blob_reference(reference)
+                if parsed is None:
+                    entries.append(self._file_entry(
+                        os.path.join('images', reference)))
+                else:
+                    blob, offset, length, _ = parsed
+                    blob_ends[blob] = max(blob_ends.get(blob, 0),
+                                          offset + length)
+        for blob, end in sorted(blob_ends.items()):
+            start = 0 if whole_files else blobs.get(blob, 0)
+            if end > start:
+                entries.append({'name': blob,
+                                'path': os.path.join(self.base_path, blob),
+                                'start': start, 'end': end})
+            blobs[blob] = max(blobs.get(blob, 0), end)
+        entries = [entry for entry in entries if entry is not None]
+        entries.append({'name': MANIFEST, 'data': contents, 'start': 0})
+        return {
+            'full': full,
+            'records': [shipped, current_index],
+            'entries': entries,
+            'state': {'generation': generation, 'records': current_index,
+                      'blobs': blobs},
+        }
+
+    def _catalog_entries(self, name, first_line, count, whole_files):
+        """ The entries of the lines [0, count) of a catalog, with the new
+            lines from first_line on. """
+        path = os.path.join(self.base_path, name)
+        with open(path, 'rb') as file:
+            contents = file.read()
+        offsets = np.frombuffer(line_end_offsets(contents, len(contents)),
+                                dtype=np.uint64)
+        if len(offsets) < count:
+            raise ValueError(f'{name} has {len(offsets)} of {count} records')
+        start_line = 0 if whole_files else first_line
+        start = int(offsets[start_line - 1]) if start_line > 0 else 0
+        stem = os.path.splitext(name)[0]
+        entries = [{'name': name, 'path': path, 'start': start,
+                    'end': int(offsets[count - 1])}]
+        if start_line == 0:
+            entries.append(self._file_entry(f'{stem}.catalog_manifest'))
+        # The line index of the shipped lines, at 8 bytes per line.
+        line_index = offsets[start_line:count].astype(
+            LineIndex.ENTRY.format).tobytes()
+        entries.append({'name': f'{stem}.catalog_index', 'data': line_index,
+                        'start': start_line * LineIndex.ITEM_SIZE})
+        first = int(offsets[first_line - 1]) if first_line > 0 else 0
+        new_lines = contents[first:int(offsets[count - 1])] \
+            .split(NEWLINE.encode())[:-1]
+        return entries, new_lines
+
+    @classmethod
+    def _image_references(cls, record_codec, lines, image_keys):
+        if not image_keys or not lines:
+            return list()
+        references = list()
+        for record in record_codec.decode_lines(lines):
+            for key in image_keys:
+                if record.get(key) is not None:
+                    references.append(record[key])
+        return references
+
+    def _file_entry(self, name):
+        path = os.path.join(self.base_path, name)
+        if not os.path.exists(path):
+            print(f'Skipping missing {path}', file=sys.stderr)
+            return None
+        return {'name': name, 'path': path, 'start': 0,
+                'end': os.path.getsize(path)}
+
+    def _target_matches(self, plan, target):
+        if not os.path.exists(os.path.join(target, MANIFEST)):
+            return False
+        for entry in plan['entries']:
+            if entry['start'] > 0:
+                path = os.path.join(target, entry['name'])
+                if not os.path.exists(path) or \
+                        os.path.getsize(path) < entry['start']:
+                    return False
+        return True
+
+    def _check_copy(self, target, generation):
+        # Copies keep the created_at of the tub, compactions included.
+        try:
+            _, lines = read_manifest_file(os.path.join(target, MANIFEST))
+            created_at = lines[3].get('created_at')
+        except (OSError, ValueError, AttributeError):
+            created_at = None
+        if created_at is None or created_at != generation[0]:
+            raise ValueError(f'{target} is not a copy of {self.base_path}, '
+                             f'it is left as it is')
+
+    def _chunks(self, entry):
+        if 'data' in entry:
+            yield entry['data']
+            return
+        with open(entry['path'], 'rb') as file:
+            file.seek(entry['start'])
+            remaining = entry['end'] - entry['start']
+            while remaining > 0:
+                chunk = file.read(min(self.chunk_size, remaining))
+                if not chunk:
+                    raise ValueError(f'{entry["path"]} is shorter than '
+                                     f'{entry["end"]} bytes')
+                remaining -= len(chunk)
+                yield chunk
+
+    @classmethod
+    def _size(cls, entry):
+        if 'data' in entry:
+            return len(entry['data'])
+        return entry['end'] - entry['start']
+
+    def _write_file(self, entry, target):
+        path = os.path.join(target, entry['name'])
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if entry['name'] == MANIFEST:
+            # Written last and atomically, it makes the new records visible.
+            temporary_path = path + '.tmp'
+            with open(temporary_path, 'wb') as file:
+                file.write(entry['data'])
+            os.replace(temporary_path, path)
+            return
+        mode = 'r+b' if entry['start'] > 0 else 'wb'
+        with open(path, mode) as file:
+            file.seek(entry['start'])
+            for chunk in self._chunks(entry):
+                file.write(chunk)
+            # Drops lines of the copy which the source never committed
+            file.truncate()
+
+    def _write_tar_entry(self, archive, entry, prefix):
+        info = tarfile.TarInfo(f'{prefix}/{entry["name"]}')
+        info.size = self._size(entry)
+        info.mtime = int(time.time())
+        if 'data' in entry:
+            archive.addfile(info, io.BytesIO(entry['data']))
+            return
+        with open(entry['path'], 'rb') as file:
+            # Copies info.size bytes, a buffer at a time
+            archive.addfile(info, file)
+
+    def _write_zip_entry(self, archive, entry, prefix):
+        with archive.open(f'{prefix}/{entry["name"]}', mode='w',
+                          force_zip64=self._size(entry) > 1 << 31) as file:
+            for chunk in self._chunks(entry):
+                file.write(chunk)
+
+    @classmethod
+    def _summary(cls, plan):
+        return {'full': plan['full'], 'records': plan['records'],
+                'files': len(plan['entries']),
+                'bytes': sum(cls._size(entry) for entry in plan['entries'])}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tub', required=True)
+    parser.add_argument('--name', default='default',
+                        help='Name of the sync target, each keeps its state')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--to', help='Directory of the copy of the tub')
+    target.add_argument('--tar', help='Tar file, - for stdout')
+    target.add_argument('--zip', help='Zip file, - for stdout')
+    parser.add_argument('--reset', action='store_true',
+                        help='Ship the whole tub again')
+    args = parser.parse_args()
+
+    sync = TubSync(args.tub, name=args.name)
+    if args.reset:
+        sync.reset()
+    if args.to is not None:
+        summary = sync.to_directory(args.to)
+    else:
+        output = args.tar if args.tar is not None else args.zip
+        if output == '-':
+            output = sys.stdout.buffer
+        summary = sync.to_archive(
+            output, FORMAT_TAR if args.tar is not None else FORMAT_ZIP)
+    print(json.dumps(summary), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,148 @@
 import atexit
 import os
+import shutil
+import threading
 import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from datetime import datetime
 import json
 
 import numpy as np
-from PIL import Image
 
-from components.datastore_v2 import Manifest, ManifestIterator
+from components.datastore_v2 import DurabilityPolicy, Manifest, \
+    ManifestIterator
+from components.image_codecs import create_image_codec, decode_image
+from components.image_store import ImageBlobWriter, ImageReader, \
+    image_extension, parse_blob_reference
+from components.tub_columns import ColumnSource, TubColumns
+from components.tub_index import TubIndex
+from components.tub_split import SPLIT_BLOCK, SPLIT_RECORD, SPLIT_SESSION, \
+    block_groups, split_indexes
+
+
+class ImageEncoder(object):
+    """
+    Encodes the images of tub records on a pool of background workers, so
+    the drive loop only pays for queueing a record. \n
+    Records are committed in order by a single committer thread once all
+    their images are encoded, so a record never points at a missing image.
+    When queue_size records are waiting, the policy decides what happens:
+    block:       wait until a record was committed
+    drop_oldest: drop the oldest record which is not being committed yet
+    drop_newest: drop the record being submitted
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    DROP_NEWEST = 'drop_newest'
+    POLICIES = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+    def __init__(self, commit, workers=1, queue_size=20, policy='block',
+                 processes=False):
+        if policy not in ImageEncoder.POLICIES:
+            raise ValueError(f'Unknown policy {policy}, expected one of '
+                             f'{ImageEncoder.POLICIES}')
+        self.commit = commit
+        self.queue_size = max(queue_size, 1)
+        self.policy = policy
+        executor = ProcessPoolExecutor if processes else ThreadPoolExecutor
+        self.executor = executor(max_workers=workers)
+        self.pending = deque()
+        self.condition = threading.Condition()
+        self.submitted = 0
+        self.committed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.running = True
+        self.committer = threading.Thread(target=self._commit_loop,
+                                          daemon=True)
+        self.committer.start()
+
+    def submit(self, contents, images):
+        """
+        Queues a record with its (key, codec, image_array) entries. Returns
+        False when the record was dropped.
+        """
+        with self.condition:
+            # Every attempt counts, whatever the policy does with it.
+            self.submitted += 1
+            while len(self.pending) >= self.queue_size:
+                if self.policy == ImageEncoder.BLOCK:
+                    self.condition.wait()
+                elif self.policy == ImageEncoder.DROP_NEWEST:
+                    self.dropped += 1
+                    return False
+                elif not self._drop_oldest():
+                    # Only the record being committed is left.
+                    self.condition.wait()
+            futures = [(key, codec,
+                        self.executor.submit(codec.encode, image_array))
+                       for key, codec, image_array in images]
+            self.pending.append({'contents': contents, 'images': futures,
+                                 'committing': False})
+            self.condition.notify_all()
+        return True
+
+    def _drop_oldest(self):
+        for job in self.pending:
+            if not job['committing']:
+                self.pending.remove(job)
+                for _, _, future in job['images']:
+                    future.cancel()
+                self.dropped += 1
+                return True
+        return False
+
+    def _commit_loop(self):
+        while True:
+            with self.condition:
+                while self.running and not self.pending:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                job = self.pending[0]
+                job['committing'] = True
+            try:
+                encoded = [(key, codec, future.result())
+                           for key, codec, future in job['images']]
+                self.commit(job['contents'], encoded)
+                committed = True
+            except Exception as e:
+                print(f'Failed to write record: {e}')
+                committed = False
+            with self.condition:
+                self.pending.popleft()
+                if committed:
+                    self.committed += 1
+                else:
+                    self.failed += 1
+                self.condition.notify_all()
+
+    def queue_depth(self):
+        return len(self.pending)
+
+    def stats(self):
+        with self.condition:
+            return {'queue_depth': len(self.pending),
+                    'submitted': self.submitted,
+                    'committed': self.committed,
+                    'dropped': self.dropped,
+                    'failed': self.failed}
+
+    def flush(self):
+        """ Waits until all queued records are committed. """
+        with self.condition:
+            while self.pending:
+                self.condition.wait()
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        self.committer.join()
+        self.executor.shutdown(wait=True)
 
 
 class Tub(object):
@@ -16,26 +151,88 @@ class Tub(object):
     Accepts str, int, float, image_array, image, and array data types.
     """
 
+    # Staging directory and commit marker used by compact()
+    COMPACT_DIR = '.compact'
+    COMPACT_COMMITTED = 'COMMITTED'
+    IMAGE_FILES = 'files'
+    IMAGE_BLOB = 'blob'
+
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_catalog_len=1000, read_only=False):
+                 max_catalog_len=1000, read_only=False, durability=None,
+                 record_codec='json', follow=False, image_workers=0,
+                 image_queue_size=20, image_policy='block',
+                 image_processes=False, image_storage='files',
+                 image_codecs=None, image_cache=None, max_open_catalogs=8):
+        """
+        durability takes a DurabilityPolicy, which controls how often
+        records and metadata are committed to disk. record_codec (json,
+        orjson or binary) is used by new tubs, existing tubs keep the codec
+        named in their manifest. follow=True opens the tub read only, and
+        iterating it keeps returning records while another process records
+        into it. max_open_catalogs bounds the catalog files kept open for
+        random access. \n
+        With image_workers > 0 images are encoded in the background, see
+        ImageEncoder for the queue and drop policies. image_storage 'files'
+        writes one file per image into the images folder, 'blob' appends
+        them to one blob file per catalog, both layouts can be read.
+        image_codecs maps image inputs to their codec settings, like
+        {'cam/image_array': {'codec': 'jpeg', 'quality': 90}}, see
+        components.image_codecs, inputs default to jpeg. image_cache takes
+        an ImageCache for load_image(), which can be shared by several tubs.
+        """
+        if image_storage not in (Tub.IMAGE_FILES, Tub.IMAGE_BLOB):
+            raise ValueError(f'Unknown image storage {image_storage}')
         self.base_path = base_path
         self.images_base_path = os.path.join(self.base_path, Tub.images())
         self.inputs = inputs
         self.types = types
         self.metadata = metadata
+        self.follow = follow
+        read_only = read_only or follow
+        if not read_only:
+            Tub._finish_compaction(os.path.expanduser(base_path))
         self.manifest = Manifest(base_path, inputs=inputs, types=types,
                                  metadata=metadata, max_len=max_catalog_len,
-                                 read_only=read_only)
+                                 read_only=read_only, durability=durability,
+                                 record_codec=record_codec,
+                                 max_open_catalogs=max_open_catalogs)
         self.input_types = dict(zip(self.inputs, self.types))
+        # Sessions and timestamps of the records, for session() and
+        # time_range(), and cached numpy columns of the records, for filter()
+        self.index = TubIndex(self.manifest.base_path.as_posix(),
+                              read_only=read_only)
+        if not read_only:
+            self.index.catch_up(self.manifest)
+        self.columns = TubColumns(self)
         # Create images folder if necessary
         if not os.path.exists(self.images_base_path):
             os.makedirs(self.images_base_path, exist_ok=True)
+        self.image_storage = image_storage
+        image_codecs = image_codecs or dict()
+        self.image_codecs = {key: create_image_codec(image_codecs.get(key))
+                             for key, input_type in self.input_types.items()
+                             if input_type == 'image_array'}
+        self.image_blobs = ImageBlobWriter(self.manifest.base_path.as_posix())
+        self.image_reader = ImageReader(self.manifest.base_path.as_posix(),
+                                        self.images_base_path)
+        self.image_cache = image_cache
+        # Serializes the changes to the manifest and index between the
+        # caller and the committer thread of the image encoder.
+        self.lock = threading.RLock()
+        self.image_encoder = None
+        if image_workers > 0:
+            self.image_encoder = ImageEncoder(self._commit_record,
+                                              workers=image_workers,
+                                              queue_size=image_queue_size,
+                                              policy=image_policy,
+                                              processes=image_processes)
 
     def write_record(self, record=None):
         """
         Can handle various data types including images.
         """
         contents = dict()
+        images = list()
         for key, value in record.items():
             if value is None:
                 continue
@@ -55,41 +252,382 @@ class Tub(object):
                 elif input_type == 'list' or input_type == 'vector':
                     contents[key] = list(value)
                 elif input_type == 'image_array':
-                    # Handle image array
-                    image = Image.fromarray(np.uint8(value))
-                    name = Tub._image_file_name(self.manifest.current_index, key)
-                    image_path = os.path.join(self.images_base_path, name)
-                    image.save(image_path)
-                    contents[key] = name
+                    # Images are encoded and saved when the record is
+                    # committed
+                    images.append((key, self.image_codecs[key], value))
 
         # Private properties
         contents['_timestamp_ms'] = int(round(time.time() * 1000))
-        contents['_index'] = self.manifest.current_index
         contents['_session_id'] = self.manifest.session_id
 
-        self.manifest.write_record(contents)
+        if self.image_encoder is None:
+            encoded = [(key, codec, codec.encode(value))
+                       for key, codec, value in images]
+            self._commit_record(contents, encoded)
+        else:
+            self.image_encoder.submit(contents, images)
+
+    def _commit_record(self, contents, images):
+        # The index is assigned here, records dropped by the image encoder
+        # do not leave gaps.
+        with self.lock:
+            index = self.manifest.current_index
+            for key, codec, image in images:
+                contents[key] = self._store_image(index, key, image,
+                                                  codec.extension)
+            contents['_index'] = index
+            self.manifest.write_record(contents)
+            self.index.append(index, contents['_session_id'],
+                              contents['_timestamp_ms'])
+
+    def _store_image(self, index, key, image, extension='.jpg'):
+        if self.image_storage == Tub.IMAGE_BLOB:
+            catalog_number = index // self.manifest.max_len
+            return self.image_blobs.append(catalog_number, image, extension)
+        name = Tub._image_file_name(index, key, extension)
+        image_path = os.path.join(self.images_base_path, name)
+        with open(image_path, 'wb') as file:
+            file.write(image)
+        return name
+
+    def read_image(self, reference):
+        """
+        Returns the encoded bytes of an image, given the image file name or
+        blob reference stored in a record. Images in blobs are returned as
+        zero copy memoryviews.
+        """
+        return self.image_reader.read(reference)
+
+    def load_image(self, reference, size=None, depth=None):
+        """
+        Decodes an image into a numpy uint8 array, with the codec matching
+        its extension, resized to size (width, height) and converted to
+        depth channels when given. Images come from the image cache, when
+        the tub has one.
+        """
+        def load():
+            return decode_image(self.read_image(reference),
+                                image_extension(reference), size, depth)
+
+        if self.image_cache is None:
+            return load()
+        key = (self.manifest.base_path.as_posix(), reference,
+               tuple(size) if size is not None else None, depth)
+        return self.image_cache.get_or_load(key, load)
+
+    def flush(self):
+        """ Waits until records queued for image encoding are written. """
+        if self.image_encoder is not None:
+            # Outside of the lock, the committer takes it
+            self.image_encoder.flush()
+        with self.lock:
+            self.index.flush()
 
     def delete_record(self, record_index):
-        self.manifest.delete_record(record_index)
+        with self.lock:
+            self.manifest.delete_record(record_index)
 
     def delete_last_n_records(self, n):
-        last_index = self.manifest.current_index
-        first_index = last_index - n
-        for index in range(first_index, last_index):
-            if index < 0:
-                continue
-            else:
-                self.manifest.delete_record(index)
+        self.flush()
+        with self.lock:
+            last_index = self.manifest.current_index
+            first_index = max(last_index - n, 0)
+            self.manifest.delete_range(first_index, last_index)
+
+    def delete_range(self, start, end):
+        with self.lock:
+            self.manifest.delete_range(start, end)
 
     def restore_record(self, record_index):
-        self.manifest.restore_record(record_index)
+        with self.lock:
+            self.manifest.restore_record(record_index)
+
+    def restore_range(self, start, end):
+        with self.lock:
+            self.manifest.restore_range(start, end)
+
+    def delete_records(self, record_indexes):
+        """ Deletes the given records, a view or an iterable of indexes,
+            with a single metadata update. """
+        runs = Tub._index_runs(record_indexes)
+        with self.lock:
+            self.manifest.delete_ranges(runs)
+
+    def restore_records(self, record_indexes):
+        runs = Tub._index_runs(record_indexes)
+        with self.lock:
+            self.manifest.restore_ranges(runs)
+
+    @classmethod
+    def _index_runs(cls, record_indexes):
+        indexes = np.unique(np.asarray(getattr(record_indexes, 'indexes',
+                                               record_indexes),
+                                       dtype=np.int64))
+        if len(indexes) == 0:
+            return []
+        breaks = np.flatnonzero(np.diff(indexes) != 1) + 1
+        starts = indexes[np.concatenate(([0], breaks))]
+        ends = indexes[np.concatenate((breaks - 1, [-1]))] + 1
+        return zip(starts.tolist(), ends.tolist())
+
+    def compact(self):
+        """
+        Rewrites the tub without its deleted records. Records are re-indexed
+        densely, their images are renamed to match and images which are no
+        longer referenced are dropped. Records are streamed, so memory use
+        does not depend on the size of the tub. \n
+        The compacted tub is written to a staging directory, with hard links
+        to the images, and swapped in once complete. An interrupted
+        compaction is rolled forward, or discarded, when the tub is opened
+        again.
+        """
+        if self.manifest.read_only:
+            raise RuntimeError(f'Tub {self.base_path} is read-only.')
+        self.flush()
+        with self.lock:
+            self._compact()
+
+    def _compact(self):
+        manifest = self.manifest
+        manifest.commit()
+        base_path = manifest.base_path.as_posix()
+        staging_path = os.path.join(base_path, Tub.COMPACT_DIR)
+        if os.path.exists(staging_path):
+            shutil.rmtree(staging_path)
+        staged_images_path = os.path.join(staging_path, Tub.images())
+        os.makedirs(staged_images_path)
+
+        image_keys = [key for key, input_type
+                      in zip(manifest.inputs, manifest.types)
+                      if input_type == 'image_array']
+        staged_blobs = ImageBlobWriter(staging_path)
+        compacted = Manifest(staging_path, inputs=manifest.inputs,
+                             types=manifest.types,
+                             metadata=manifest.metadata.items(),
+                             max_len=manifest.max_len,
+                             durability=DurabilityPolicy('close'),
+                             record_codec=manifest.record_codec.name)
+        for record in ManifestIterator(manifest):
+            index = compacted.current_index
+            for key in image_keys:
+                name = record.get(key)
+                if name is None:
+                    continue
+                blob = parse_blob_reference(name)
+                if blob is not None:
+                    # Blobs are rewritten per catalog, images are copied.
+                    catalog_number = index // compacted.max_len
+                    new_name = staged_blobs.append(catalog_number,
+                                                   self.read_image(name),
+                                                   blob[3])
+                else:
+                    new_name = Tub._image_file_name(index, key,
+                                                    image_extension(name))
+                    Tub._link_image(
+                        os.path.join(self.images_base_path, name),
+                        os.path.join(staged_images_path, new_name))
+                record[key] = new_name
+            record['_index'] = index
+            compacted.write_record(record)
+        # Keep the session history of the original tub. compacted_at marks
+        # the re-indexing for caches of record indexes, like TubCache.
+        compacted.manifest_metadata = dict(manifest.manifest_metadata)
+        compacted.manifest_metadata['compacted_at'] = time.time()
+        compacted._updated_session = True
+        compacted.close()
+        staged_blobs.close()
+        removed = manifest.current_index - compacted.current_index
+
+        staged_files = sorted(name for name in os.listdir(staging_path)
+                              if os.path.isfile(os.path.join(staging_path,
+                                                             name)))
+        marker_path = os.path.join(staging_path, Tub.COMPACT_COMMITTED)
+        with open(marker_path, 'w') as marker:
+            marker.write(json.dumps(staged_files))
+            marker.flush()
+            os.fsync(marker.fileno())
+        manifest.close()
+        self.index.close()
+        self.image_blobs.close()
+        self.image_reader.close()
+        if self.image_cache is not None:
+            self.image_cache.discard(base_path)
+        Tub._finish_compaction(base_path)
+        # The same session goes on, with the same catalog handles bound.
+        self.manifest = Manifest(base_path, read_only=False,
+                                 durability=manifest.durability,
+                                 max_open_catalogs=manifest.max_open_catalogs,
+                                 session_id=manifest.session_id)
+        self.index = TubIndex(base_path)
+        self.index.catch_up(self.manifest)
+        self.index.flush()
+        self.columns = TubColumns(self)
+        print(f'Compacted {base_path}, removed {removed} deleted records.')
+
+    @classmethod
+    def _link_image(cls, source, target):
+        if not os.path.exists(source):
+            print(f'Missing image {source}')
+            return
+        try:
+            os.link(source, target)
+        except OSError:
+            # File systems without hard links
+            shutil.copy2(source, target)
+
+    @classmethod
+    def _finish_compaction(cls, base_path):
+        """
+        Swaps a compacted tub into place. Every step can be repeated, so a
+        swap interrupted by a crash is completed on the next call.
+        """
+        staging_path = os.path.join(base_path, Tub.COMPACT_DIR)
+        if not os.path.isdir(staging_path):
+            return
+        marker_path = os.path.join(staging_path, Tub.COMPACT_COMMITTED)
+        if not os.path.exists(marker_path):
+            print(f'Discarding incomplete compaction of {base_path}')
+            shutil.rmtree(staging_path)
+            return
+        with open(marker_path, 'r') as marker:
+            staged_files = json.loads(marker.read())
+
+        images_path = os.path.join(base_path, Tub.images())
+        staged_images_path = os.path.join(staging_path, Tub.images())
+        old_images_path = os.path.join(staging_path, 'images_old')
+        if os.path.isdir(staged_images_path):
+            if os.path.isdir(images_path):
+                os.replace(images_path, old_images_path)
+            os.replace(staged_images_path, images_path)
+        # Catalogs which are not part of the compacted tub
+        for name in os.listdir(base_path):
+            if name.startswith('catalog_') and name not in staged_files:
+                os.remove(os.path.join(base_path, name))
+        # The record indexes changed, the index is rebuilt on open.
+        TubIndex.remove(base_path)
+        # The manifest goes last, it refers to the catalogs.
+        staged_files.sort(key=lambda name: name == 'manifest.json')
+        for name in staged_files:
+            staged_path = os.path.join(staging_path, name)
+            if os.path.exists(staged_path):
+                os.replace(staged_path, os.path.join(base_path, name))
+        shutil.rmtree(staging_path)
 
     def close(self):
+        if self.image_encoder is not None:
+            self.image_encoder.close()
+        self.image_blobs.close()
+        self.image_reader.close()
+        self.index.close()
         self.manifest.close()
 
+    def get_records(self, record_indexes):
+        """
+        Reads the records with the given indexes in the given order, each
+        record is a single positional read of its catalog.
+        """
+        return self.manifest.read_records(record_indexes)
+
+    def view(self, record_indexes=None):
+        return self.manifest.view(record_indexes)
+
+    def sessions(self):
+        """ The _session_id of the sessions recorded into the tub. """
+        self._catch_up_index()
+        return self.index.session_ids()
+
+    def session(self, session_id):
+        """ A lazy view over the records of a session. """
+        self._catch_up_index()
+        ranges = self.index.session_indexes(session_id).ranges()
+        if len(ranges) == 1:
+            return self.view(range(*ranges[0]))
+        return self.view(np.concatenate([np.arange(start, end)
+                                         for start, end in ranges]))
+
+    def time_range(self, start_ms, end_ms):
+        """ A lazy view over the records with a _timestamp_ms in
+            [start_ms, end_ms). """
+        self._catch_up_index()
+        return self.view(self.index.time_range(start_ms, end_ms))
+
+    def column(self, key):
+        """ The values of key for every record index, as a numpy array. """
+        return self.columns.column(key)
+
+    def filter(self, predicate):
+        """
+        Returns a lazy view over the records matching predicate, deleted
+        records excluded. predicate takes a mapping of the columns, numpy
+        arrays indexed by record index, and returns a boolean array, for
+        example lambda c: (c['user/throttle'] > 0.1) & (c['user/mode'] ==
+        'user'). Only the columns it reads are loaded.
+        """
+        mask = np.asarray(predicate(ColumnSource(self.columns)), dtype=bool)
+        return self.view(np.flatnonzero(mask))
+
+    def split(self, test_size=0.2, by=SPLIT_RECORD, block_size=1000,
+              seed=None, records=None):
+        """
+        Splits the records, or a view of them, into lazy (train, validation)
+        views. by='record' draws single records, by='session' keeps every
+        _session_id on one side and by='block' keeps runs of block_size
+        consecutive records on one side, so validation frames are not next
+        to training frames.
+        """
+        indexes = self.view(getattr(records, 'indexes', records)).indexes
+        if by == SPLIT_RECORD:
+            groups = None
+        elif by == SPLIT_SESSION:
+            self._catch_up_index()
+            groups = self.index.session_codes()[indexes]
+        elif by == SPLIT_BLOCK:
+            groups = block_groups(len(indexes), block_size)
+        else:
+            raise ValueError(f'Unknown split {by}')
+        train, validation = split_indexes(indexes, test_size, groups, seed)
+        return self.view(train), self.view(validation)
+
+    def verify(self, workers=4, check_images=True):
+        """
+        Checks the catalogs, line indexes and images of the tub and returns
+        a json serializable report, see TubVerifier. Repairs are made on a
+        closed tub, with TubVerifier.repair() or python -m
+        components.tub_verify --fix.
+        """
+        from components.tub_verify import TubVerifier
+        if not self.manifest.read_only:
+            self.flush()
+            with self.lock:
+                self.manifest.commit()
+        verifier = TubVerifier(self.manifest.base_path.as_posix(),
+                               workers=workers, check_images=check_images)
+        return verifier.verify()
+
+    def _catch_up_index(self):
+        # Read only tubs catch up on first use, and when following a tub
+        # which is written by another process.
+        with self.lock:
+            if len(self.index) < self.manifest.current_index:
+                self.index.catch_up(self.manifest)
+
+    def follow_records(self, poll_interval=0.05, timeout=None):
+        """
+        Returns records as they are written, by another process or by this
+        tub, polling every poll_interval seconds. Stops after timeout seconds
+        without new records, or never when timeout is None.
+        """
+        return self.manifest.follow(poll_interval=poll_interval,
+                                    timeout=timeout)
+
     def __iter__(self):
+        if self.follow:
+            return self.follow_records()
         return ManifestIterator(self.manifest)
 
+    def __getitem__(self, item):
+        return self.manifest[item]
+
     def __len__(self):
         return self.manifest.__len__()
 
@@ -110,8 +648,18 @@ class TubWriter(object):
     A part, which can write records to the datastore.
     """
     def __init__(self, base_path, inputs=[], types=[], metadata=[],
-                 max_catalog_len=1000):
-        self.tub = Tub(base_path, inputs, types, metadata, max_catalog_len)
+                 max_catalog_len=1000, durability=None, record_codec='json',
+                 image_workers=0, image_queue_size=20, image_policy='block',
+                 image_processes=False, image_storage='files',
+                 image_codecs=None):
+        self.tub = Tub(base_path, inputs, types, metadata, max_catalog_len,
+                       durability=durability, record_codec=record_codec,
+                       image_workers=image_workers,
+                       image_queue_size=image_queue_size,
+                       image_policy=image_policy,
+                       image_processes=image_processes,
+                       image_storage=image_storage,
+                       image_codecs=image_codecs)
 
     def run(self, *args):
         assert len(self.tub.inputs) == len(args), \
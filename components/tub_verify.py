@@ -0,0 +1,340 @@
+#!/usr/bin/env python3
+"""
+Checks a tub for damage left by power cuts, and repairs it.
+
+Usage: python -m components.tub_verify --tub ~/mycar/data [--fix]
+       [--workers 4] [--no-images]
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from components.datastore_v2 import IndexRanges, LineIndex, NEWLINE, \
+    line_end_offsets, read_manifest_file, record_codec_from_description
+from components.image_codecs import decode_image
+from components.image_store import ImageReader, image_extension
+
+
+IMAGE_TYPES = ('image_array', 'image')
+# What repair() does about an issue, None when it can not be repaired.
+FIX_TRUNCATE = 'truncate'
+FIX_DELETE = 'delete'
+FIX_REBUILD_INDEX = 'rebuild_index'
+FIX_RECOVER = 'recover'
+
+
+class TubVerifier(object):
+    """
+    Verifies the files of a tub without trusting them, the way they are
+    left on disk by a power cut: \n
+    - catalog lines which were cut short or do not decode, and records which
+      do not hold their own _index,
+    - catalog line indexes and start indexes which are out of sync with
+      their catalogs,
+    - a current_index in manifest.json which does not match the catalogs,
+    - images which are missing or do not decode, for records which are not
+      deleted. Images are checked by a pool of workers threads. \n
+    verify() returns a json serializable report, with an issue per problem
+    and the fix that repair() applies to it. repair() truncates cut lines at
+    the end of the tub, replaces other bad lines by placeholders, rewrites
+    line indexes, recovers the current index and marks bad records deleted.
+    The tub must not be open for writing while it is repaired.
+    """
+
+    MANIFEST = 'manifest.json'
+    CACHE_DIR = 'cache'
+
+    def __init__(self, base_path, workers=4, check_images=True):
+        self.base_path = os.path.expanduser(base_path)
+        self.workers = workers
+        self.check_images = check_images
+
+    def verify(self):
+        report = {'tub': self.base_path, 'records': 0, 'current_index': None,
+                  'checked_images': 0, 'issues': list()}
+        issues = report['issues']
+        try:
+            manifest = self._read_manifest()
+        except (OSError, ValueError, KeyError, IndexError) as exception:
+            issues.append(self._issue('corrupt_manifest', None, None,
+                                      str(exception), None))
+            report['ok'] = False
+            return report
+        inputs, types, manifest_metadata, catalog_metadata = manifest
+        record_codec = record_codec_from_description(
+            manifest_metadata.get('record_codec'))
+        max_len = catalog_metadata['max_len']
+        deleted = IndexRanges.from_catalog_metadata(catalog_metadata)
+        image_keys = [key for key, input_type in zip(inputs, types)
+                      if input_type in IMAGE_TYPES]
+        report['current_index'] = catalog_metadata['current_index']
+        images = list()
+        records = 0
+        paths = catalog_metadata['paths']
+        for catalog_number, name in enumerate(paths):
+            path = os.path.join(self.base_path, name)
+            if not os.path.exists(path):
+                issues.append(self._issue('missing_catalog', name, None,
+                                          f'{name} does not exist', None))
+                continue
+            is_last = catalog_number == len(paths) - 1
+            start = catalog_number * max_len
+            lines = self._verify_catalog(path, start, is_last, record_codec,
+                                         issues)
+            # Like opening the tub, the last catalog sets the record count
+            records = start + lines
+            if image_keys:
+                images.extend(self._image_references(
+                    path, start, record_codec, image_keys, deleted))
+        report['records'] = records
+        unlisted = f'catalog_{len(paths)}.catalog'
+        if os.path.exists(os.path.join(self.base_path, unlisted)):
+            issues.append(self._issue('unlisted_catalog', unlisted, None,
+                                      f'{unlisted} is not in manifest.json',
+                                      FIX_RECOVER))
+        if records != catalog_metadata['current_index']:
+            issues.append(self._issue(
+                'current_index_mismatch', None, None,
+                f'manifest.json has {catalog_metadata["current_index"]} '
+                f'records, the catalogs {records}', FIX_RECOVER))
+        if self.check_images and images:
+            report['checked_images'] = len(images)
+            issues.extend(self._verify_images(images))
+        report['ok'] = len(issues) == 0
+        return report
+
+    def repair(self, report=None):
+        """
+        Repairs the issues of a report, verify() is run when none is given.
+        Returns the report of a verification made after the repair, with the
+        fixes which were applied.
+        """
+        from components.tub_v2 import Tub
+        if report is None:
+            report = self.verify()
+        fixed = list()
+        rewrites = dict()
+        deletes = set()
+        for issue in report['issues']:
+            fix = issue['fix']
+            if fix == FIX_TRUNCATE:
+                self._truncate_last_line(issue['catalog'])
+            elif fix == FIX_DELETE:
+                deletes.add(issue['record'])
+                if issue['issue'] in ('truncated_line', 'undecodable_record'):
+                    rewrites.setdefault(issue['catalog'], set()) \
+                        .add(issue['record'])
+            elif fix == FIX_REBUILD_INDEX:
+                self._rebuild_line_index(issue['catalog'])
+            elif fix is None:
+                continue
+            fixed.append(issue)
+        for name, record_indexes in rewrites.items():
+            self._replace_lines(name, record_indexes)
+        if rewrites or any(issue['fix'] == FIX_TRUNCATE for issue in fixed):
+            # Derived caches may hold the records which were removed.
+            shutil.rmtree(os.path.join(self.base_path, TubVerifier.CACHE_DIR),
+                          ignore_errors=True)
+        if fixed:
+            # Opening the tub recovers catalogs and the current index.
+            tub = Tub(self.base_path)
+            if deletes:
+                tub.delete_records(sorted(deletes))
+            tub.close()
+        repaired = self.verify()
+        repaired['fixed'] = fixed
+        return repaired
+
+    def _read_manifest(self):
+        _, lines = read_manifest_file(
+            os.path.join(self.base_path, TubVerifier.MANIFEST))
+        inputs, types, _, manifest_metadata, catalog_metadata = lines
+        return inputs, types, manifest_metadata, catalog_metadata
+
+    def _verify_catalog(self, path, start, is_last, record_codec, issues):
+        """ Checks the lines of a catalog, returns its number of complete
+            lines. """
+        name = os.path.basename(path)
+        with open(path, 'rb') as file:
+            contents = file.read()
+        offsets = np.frombuffer(line_end_offsets(contents, len(contents)),
+                                dtype=np.uint64)
+        lines = contents.split(NEWLINE.encode())
+        complete = len(lines) - 1
+        if lines[-1]:
+            issues.append(self._issue(
+                'truncated_line', name, start + complete,
+                f'{len(lines[-1])} bytes without a newline',
+                FIX_TRUNCATE if is_last else FIX_DELETE))
+        for position, line in enumerate(lines[:complete]):
+            index = start + position
+            try:
+                record = record_codec.decode(line)
+            except Exception as exception:
+                issues.append(self._issue('undecodable_record', name, index,
+                                          str(exception), FIX_DELETE))
+                continue
+            if record.get('_index', index) != index:
+                issues.append(self._issue(
+                    'wrong_index', name, index,
+                    f'The record has _index {record.get("_index")}',
+                    FIX_DELETE))
+        stem = os.path.splitext(path)[0]
+        catalog_manifest = self._read_catalog_manifest(stem)
+        if catalog_manifest is not None and \
+                catalog_manifest.get('start_index') != start:
+            issues.append(self._issue(
+                'start_index_mismatch', name, None,
+                f'Starts at {catalog_manifest.get("start_index")} instead '
+                f'of {start}', None))
+        legacy = catalog_manifest is not None \
+            and 'line_lengths' in catalog_manifest
+        index_path = f'{stem}.catalog_index'
+        if os.path.exists(index_path):
+            line_index = np.fromfile(index_path, dtype=LineIndex.ENTRY.format)
+            if not np.array_equal(line_index, offsets):
+                detail = f'{len(line_index)} indexed lines, {len(offsets)} ' \
+                    f'lines' if len(line_index) != len(offsets) \
+                    else 'The line offsets differ'
+                issues.append(self._issue('line_index_mismatch', name, None,
+                                          detail, FIX_REBUILD_INDEX))
+        elif not legacy and len(offsets) > 0:
+            issues.append(self._issue('line_index_mismatch', name, None,
+                                      'The line index is missing',
+                                      FIX_REBUILD_INDEX))
+        return complete
+
+    @classmethod
+    def _read_catalog_manifest(cls, stem):
+        try:
+            with open(f'{stem}.catalog_manifest', 'r') as file:
+                return json.loads(file.readline())
+        except (OSError, ValueError):
+            return None
+
+    def _image_references(self, path, start, record_codec, image_keys,
+                          deleted):
+        with open(path, 'rb') as file:
+            lines = file.read().split(NEWLINE.encode())[:-1]
+        references = list()
+        for position, line in enumerate(lines):
+            index = start + position
+            if index in deleted:
+                continue
+            try:
+                record = record_codec.decode(line)
+            except Exception:
+                # Reported by _verify_catalog()
+                continue
+            for key in image_keys:
+                if record.get(key) is not None:
+                    references.append((index, key, record[key]))
+        return references
+
+    def _verify_images(self, images):
+        chunks = np.array_split(np.arange(len(images)),
+                                max(min(self.workers, len(images)), 1))
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as pool:
+            results = pool.map(
+                lambda chunk: self._verify_image_chunk(
+                    [images[i] for i in chunk]), chunks)
+            return [issue for issues in results for issue in issues]
+
+    def _verify_image_chunk(self, images):
+        # A reader per worker, readers keep a cache of mapped blobs.
+        reader = ImageReader(self.base_path,
+                             os.path.join(self.base_path, 'images'))
+        issues = list()
+        for index, key, reference in images:
+            try:
+                contents = reader.read(reference)
+            except (OSError, ValueError) as exception:
+                issues.append(self._issue('missing_image', None, index,
+                                          f'{key} {reference}: {exception}',
+                                          FIX_DELETE))
+                continue
+            try:
+                decode_image(contents, image_extension(reference))
+            except Exception as exception:
+                issues.append(self._issue('corrupt_image', None, index,
+                                          f'{key} {reference}: {exception}',
+                                          FIX_DELETE))
+            finally:
+                del contents
+        reader.close()
+        return issues
+
+    def _truncate_last_line(self, name):
+        path = os.path.join(self.base_path, name)
+        with open(path, 'rb+') as file:
+            contents = file.read()
+            file.truncate(contents.rfind(NEWLINE.encode()) + 1)
+        self._rebuild_line_index(name)
+
+    def _rebuild_line_index(self, name):
+        path = os.path.join(self.base_path, name)
+        with open(path, 'rb') as file:
+            contents = file.read()
+        line_index = LineIndex(f'{os.path.splitext(path)[0]}.catalog_index',
+                               auto_flush=False)
+        line_index.truncate(0)
+        line_index.extend(line_end_offsets(contents, len(contents)))
+        line_index.flush(fsync=True)
+        line_index.close()
+
+    def _replace_lines(self, name, record_indexes):
+        """ Replaces bad lines by a placeholder record, so the catalog
+            decodes again. The records are deleted afterwards. """
+        path = os.path.join(self.base_path, name)
+        stem = os.path.splitext(path)[0]
+        start = self._read_catalog_manifest(stem)['start_index']
+        _, _, manifest_metadata, _ = self._read_manifest()
+        record_codec = record_codec_from_description(
+            manifest_metadata.get('record_codec'))
+        with open(path, 'rb') as file:
+            lines = file.read().split(NEWLINE.encode())
+        for index in record_indexes:
+            position = index - start
+            if 0 <= position < len(lines):
+                lines[position] = record_codec.encode(
+                    {'_index': index}).encode()
+        if lines[-1]:
+            # A cut line which was replaced now ends the catalog
+            lines.append(b'')
+        temporary_path = path + '.tmp'
+        with open(temporary_path, 'wb') as file:
+            file.write(NEWLINE.encode().join(lines))
+            file.flush()
+            os.fsync(file.fileno())
+        os.replace(temporary_path, path)
+        self._rebuild_line_index(name)
+
+    @classmethod
+    def _issue(cls, issue, catalog, record, detail, fix):
+        return {'issue': issue, 'catalog': catalog, 'record': record,
+                'detail': detail, 'fix': fix}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--tub', required=True)
+    parser.add_argument('--fix', action='store_true',
+                        help='Repair the issues which can be repaired')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--no-images', action='store_true')
+    args = parser.parse_args()
+
+    verifier = TubVerifier(args.tub, workers=args.workers,
+                           check_images=not args.no_images)
+    report = verifier.repair() if args.fix else verifier.verify()
+    print(json.dumps(report, indent=2))
+    sys.exit(0 if report['ok'] else 1)
+
+
+if __name__ == '__main__':
+    main()
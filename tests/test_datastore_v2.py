@@ -0,0 +1,43 @@
+import math
+import os
+
+import pytest
+
+from components.datastore_v2 import JsonRecordCodec, Manifest, \
+    OrjsonRecordCodec
+
+
+def write_records(manifest, start, end):
+    for index in range(start, end):
+        manifest.write_record({'_index': index, 'user/angle': index / 10})
+
+
+def test_recovers_from_a_line_cut_short(tmp_path):
+    manifest = Manifest(tmp_path, inputs=['user/angle'], types=['float'],
+                        max_len=10)
+    write_records(manifest, 0, 5)
+    manifest.close()
+    # A power cut in the middle of writing record 5
+    with open(tmp_path / 'catalog_0.catalog', 'a') as file:
+        file.write('{"_index": 5, "user/an')
+
+    manifest = Manifest(tmp_path)
+    assert manifest.current_index == 5
+    write_records(manifest, 5, 7)
+    manifest.close()
+
+    # The line index is rebuilt from the catalog
+    os.remove(tmp_path / 'catalog_0.catalog_index')
+    manifest = Manifest(tmp_path, read_only=True)
+    records = list(manifest)
+    manifest.close()
+    assert [record['_index'] for record in records] == list(range(7))
+
+
+@pytest.mark.parametrize('codec', [JsonRecordCodec(), OrjsonRecordCodec()])
+def test_codecs_reject_non_finite_floats(codec):
+    for value in (math.nan, math.inf, -math.inf):
+        with pytest.raises(ValueError):
+            codec.encode({'user/angle': value})
+        with pytest.raises(ValueError):
+            codec.encode({'vector': [0.0, value]})
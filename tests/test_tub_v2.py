@@ -0,0 +1,35 @@
+from components.datastore_v2 import DurabilityPolicy
+from components.tub_v2 import Tub
+
+
+def test_follow_a_tub_while_writing_it(tmp_path):
+    tub = Tub(tmp_path, inputs=['user/angle'], types=['float'],
+              max_catalog_len=10,
+              durability=DurabilityPolicy('count', every_n=5))
+    for index in range(12):
+        tub.write_record({'user/angle': index})
+    tub.flush()
+    tub.manifest.commit()
+    records = tub.follow_records(poll_interval=0.01, timeout=0.05)
+    assert [record['_index'] for record in records] == list(range(12))
+    for index in range(12, 15):
+        tub.write_record({'user/angle': index})
+    assert tub.manifest.current_index == 15
+    tub.close()
+
+    tub = Tub(tmp_path, read_only=True)
+    assert [record['_index'] for record in tub] == list(range(15))
+    tub.close()
+
+
+def test_follow_records_holding_line_separators(tmp_path):
+    tub = Tub(tmp_path, inputs=['user/mode'], types=['str'],
+              record_codec='orjson')
+    modes = ['user\u2028', 'pilot\x1c\x85', 'local\u2029']
+    for mode in modes:
+        tub.write_record({'user/mode': mode})
+    tub.delete_record(1)
+    records = list(tub.follow_records(poll_interval=0.01, timeout=0.05))
+    tub.close()
+    assert [(record['_index'], record['user/mode']) for record in records] \
+        == [(0, modes[0]), (2, modes[2])]